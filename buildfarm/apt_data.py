@@ -2,44 +2,147 @@
 
 from __future__ import print_function
 
-import gzip
+import bz2
+import cPickle
+import hashlib
+import itertools
 import logging
+from multiprocessing.pool import ThreadPool
 import os
-import socket
-from StringIO import StringIO
+from array import array
+import re
+import tempfile
 import time
 import urllib2
 import yaml
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
 from rospkg.distro import distro_uri
 
+from . import http_client
+from .pdiff import get_diff_index_url, update_with_pdiff
+
+# size of the blocks read from apt list files while parsing them
+READ_CHUNK_SIZE = 1024 * 1024
+
+# increment when the content of AptData snapshots changes
+SNAPSHOT_FORMAT_VERSION = 1
+
+# compressions of apt list files which can be decompressed
+COMPRESSIONS = (['.xz'] if lzma else []) + ['.bz2', '.gz']
+
 
-def get_version_data(rootdir, rosdistro_name, ros_repos, distro_arches, apt_update=True):
+def get_version_data(rootdir, rosdistro_name, ros_repos, distro_arches, apt_update=True, skip_unchanged=False, jobs=1, snapshot_file=None, use_pdiff=False, name_filter=None):
     rosdistro_data = RosdistroData(rosdistro_name)
 
-    apt_data = AptData(rosdistro_name)
+    apt_data = get_apt_data(rootdir, ros_repos, distro_arches, apt_update=apt_update,
+                            skip_unchanged=skip_unchanged, jobs=jobs,
+                            snapshot_file=snapshot_file, use_pdiff=use_pdiff,
+                            rosdistro_name=rosdistro_name, name_filter=name_filter)
 
-    # repo type (building, shadow-fixed, ros)
+    return rosdistro_data, apt_data
+
+
+def get_apt_data(rootdir, ros_repos, distro_arches, apt_update=True, skip_unchanged=False, jobs=1, snapshot_file=None, use_pdiff=False, rosdistro_name=None, name_filter=None, timings=None):
+    """
+    Fetch and parse the apt lists of all repos for the given distro/arch
+    pairs. The resulting AptData can be shared between multiple rosdistros
+    targeting (a subset of) the same distros.
+    Only packages accepted by the name_filter are stored (see iter_stanzas()).
+    @param snapshot_file: path of the parsed apt data to reuse, the actual
+      file name includes a key of the repos, distro/arch pairs and name
+      filter (see get_snapshot_file())
+    @param timings: dict to add the seconds spent parsing the lists
+      ('parse') and waiting for their download ('fetch') to
+    """
+    apt_data = AptData(rosdistro_name, name_filter=name_filter)
+    if snapshot_file:
+        snapshot_file = get_snapshot_file(snapshot_file, ros_repos, distro_arches, name_filter)
+        apt_data.load_snapshot(snapshot_file)
+
+    distros = sorted(set([d for (d, a) in distro_arches]))
+
+    # list of source and binary packages for each repo type (building, shadow-fixed, ros)
+    apt_lists = []
     for repo_type in ros_repos:
-        for d in set([d for (d, a) in distro_arches]):
-            # download list of source packages
+        for d in distros:
+            apt_lists.append((repo_type, d, 'source'))
+            for a in [a for (d2, a) in distro_arches if d2 == d]:
+                apt_lists.append((repo_type, d, a))
+
+    def fetch_release_hashes(repo_type_distro):
+        repo_type, d = repo_type_distro
+        return get_release_hashes(ros_repos[repo_type], d)
+
+    def fetch_apt_list(apt_list):
+        repo_type, d, a = apt_list
+        if a == 'source':
             da_str = "%s_source" % d
             dst_filename = 'Sources'
-            url = os.path.join(ros_repos[repo_type], 'dists/%s/main/source/Sources.gz' % d)
-            datafile = fetch_gzip_file(rootdir, repo_type, da_str, url, dst_filename, reuse_existing=not apt_update)
-            # extract information
-            apt_data.fill_versions(repo_type, d, 'source', datafile)
-
-        for (d, a) in distro_arches:
-            # download list of binary packages
+            path = 'main/source/Sources'
+        else:
             da_str = "%s_%s" % (d, a)
             dst_filename = 'Packages'
-            url = os.path.join(ros_repos[repo_type], 'dists/%s/main/binary-%s/Packages.gz' % (d, a))
-            datafile = fetch_gzip_file(rootdir, repo_type, da_str, url, dst_filename, reuse_existing=not apt_update)
-            # extract information
+            path = 'main/binary-%s/Packages' % a
+        # download the smallest compressed list
+        hashes = release_hashes.get((repo_type, d), {})
+        available = [(hashes[path + ext][1], ext) for ext in COMPRESSIONS if path + ext in hashes]
+        path += min(available)[1] if available else '.gz'
+        url = os.path.join(ros_repos[repo_type], 'dists/%s/%s' % (d, path))
+        sha256 = hashes.get(path, (None, None))[0] if skip_unchanged else None
+        datafile = fetch_gzip_file(rootdir, repo_type, da_str, url, dst_filename, reuse_existing=not apt_update, expected_sha256=sha256, use_pdiff=use_pdiff)
+        return apt_list, datafile
+
+    # download the lists concurrently and extract the information
+    # from each list as soon as it is available
+    start_time = time.time()
+    parse_duration = 0
+    pool = ThreadPool(jobs) if jobs > 1 else None
+    imap = pool.imap_unordered if pool else itertools.imap
+    try:
+        # fetch the checksums and sizes of all lists of each distro once
+        release_hashes = {}
+        if apt_update:
+            repo_type_distros = [(repo_type, d) for repo_type in ros_repos for d in distros]
+            release_hashes = dict(zip(repo_type_distros, (pool.map if pool else map)(fetch_release_hashes, repo_type_distros)))
+
+        for (repo_type, d, a), datafile in imap(fetch_apt_list, apt_lists):
+            parse_start_time = time.time()
             apt_data.fill_versions(repo_type, d, a, datafile)
-
-    return rosdistro_data, apt_data
+            parse_duration += time.time() - parse_start_time
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+    if timings is not None:
+        timings['parse'] = timings.get('parse', 0) + parse_duration
+        timings['fetch'] = timings.get('fetch', 0) + time.time() - start_time - parse_duration
+
+    if snapshot_file:
+        apt_data.save_snapshot(snapshot_file)
+
+    return apt_data
+
+
+def get_snapshot_file(snapshot_file, ros_repos, distro_arches, name_filter=None):
+    """
+    Return the path of the snapshot of the apt data for the repos, distro/arch
+    pairs and name filter, e.g. 'apt_data.0123456789ab.pickle' for
+    'apt_data.pickle'.
+    Invocations for different rosdistros therefore keep separate snapshots
+    instead of invalidating each other's.
+    """
+    key = repr((sorted(ros_repos.items()), sorted(set(distro_arches)), get_name_filter_key(name_filter)))
+    base, ext = os.path.splitext(snapshot_file)
+    return '%s.%s%s' % (base, hashlib.sha1(key).hexdigest()[:12], ext)
 
 
 class RosdistroData(object):
@@ -64,7 +167,7 @@ class RosdistroData(object):
 
         # load dry rosdistro stacks
         if rosdistro_name == 'groovy':
-            dry_yaml = yaml.load(urllib2.urlopen(distro_uri(rosdistro_name)))
+            dry_yaml = yaml.load(http_client.fetch(distro_uri(rosdistro_name)))
             stacks = dry_yaml['stacks'] or {}
             for stack_name, d in stacks.items():
                 if stack_name == '_rules':
@@ -98,15 +201,70 @@ class RosdistroVersion(object):
 
 
 class AptData(object):
-    def __init__(self, rosdistro_name):
+    """
+    Versions of all debian packages for each (repo_type, distro_arch) column.
+
+    The versions are stored in columns of version ids indexed by the row of
+    the package. Each distinct version string is only stored once.
+    """
+
+    def __init__(self, rosdistro_name=None, name_filter=None):
         self.rosdistro_name = rosdistro_name
+        self.name_filter = name_filter
+        # map debian package names to their row
         self.debian_packages = {}
+        # map (repo_type, distro_arch) tuples to their column
+        self._columns = {}
+        # one array of version ids per column
+        self._table = []
+        # interned version strings, id 0 represents a missing version
+        self._versions = [None]
+        self._version_ids = {None: 0}
+        # checksum of the list file each column has been filled from
+        self._column_hashes = {}
+        # columns which have been filled since the snapshot was loaded
+        self._filled_columns = set()
+        self._from_snapshot = False
+        self._modified = False
         self._primary_arch = None  # fill with the first used arch
 
     def get_version(self, debian_name, repo_type, distro_arch):
-        if not debian_name in self.debian_packages:
+        row = self.debian_packages.get(debian_name)
+        column = self._columns.get((repo_type, distro_arch))
+        if row is None or column is None:
             return None
-        return self.debian_packages[debian_name].get_version(repo_type, distro_arch)
+        return self._versions[self._table[column][row]]
+
+    def get_row(self, debian_name, columns):
+        """
+        Return the versions of a debian package for a list of
+        (repo_type, distro_arch) tuples.
+        """
+        row = self.debian_packages.get(debian_name)
+        if row is None:
+            return [None] * len(columns)
+        versions = self._versions
+        table = self._table
+        result = []
+        for key in columns:
+            column = self._columns.get(key)
+            result.append(versions[table[column][row]] if column is not None else None)
+        return result
+
+    def get_column(self, repo_type, distro_arch):
+        """
+        Return the version ids of all debian packages for a
+        (repo_type, distro_arch) tuple, indexed by the row of the package
+        (see debian_packages).
+        The version strings are resolved with get_version_strings().
+        """
+        column = self._columns.get((repo_type, distro_arch))
+        if column is None:
+            return array('I', [0]) * len(self.debian_packages)
+        return self._table[column]
+
+    def get_version_strings(self):
+        return self._versions
 
     def fill_versions(self, repo_type, distro, arch, datafile):
         """
@@ -116,71 +274,389 @@ class AptData(object):
         if not self._primary_arch:
             self._primary_arch = arch
 
+        column_index = self._get_column_index(repo_type, '%s_%s' % (distro, arch))
+        self._filled_columns.add(column_index)
+        file_hash = _hash_file(datafile)
+        if self._column_hashes.get(column_index) == file_hash:
+            logging.debug('Reuse parsed file: %s' % datafile)
+            return
+
         logging.debug('Reading file: %s' % datafile)
-        data = {}
-        # split package blocks
+        if column_index in self._column_hashes:
+            # drop the versions parsed from a previous version of the file
+            self._table[column_index] = array('I', [0]) * len(self.debian_packages)
+        self._column_hashes[column_index] = file_hash
+        self._modified = True
+        column = self._table[column_index]
         with open(datafile, 'r') as f:
-            blocks = f.read().split('\n\n')
-        blocks = [b.splitlines() for b in blocks if b]
-        # create dict by package name
-        for block in blocks:
-            prefix = 'Package: '
-            assert block[0].startswith(prefix)
-            data[block[0][len(prefix):]] = block
-
-        for debian_name in data:
-            pkg_data = data[debian_name]
-            # extract version of package
-            prefix = 'Version: '
-            versions = [l for l in pkg_data if l.startswith(prefix)]
-            version = versions[0] if len(versions) == 1 else None
-            if debian_name not in self.debian_packages:
-                self.debian_packages[debian_name] = AptVersion(debian_name)
-            self.debian_packages[debian_name].add_version(repo_type, '%s_%s' % (distro, arch), version)
-
-
-class AptVersion(object):
-
-    def __init__(self, debian_name):
-        self.debian_name = debian_name
-        self._versions = {}
-
-    def add_version(self, repo_type, distro_arch, version):
-        self._versions[(repo_type, distro_arch)] = version
-
-    def get_version(self, repo_type, distro_arch):
-        return self._versions.get((repo_type, distro_arch), None)
+            for debian_name, version in iter_package_versions(f, name_filter=self.name_filter):
+                row = self.debian_packages.get(debian_name)
+                if row is None:
+                    row = self._add_package(debian_name)
+                version_id = self._version_ids.get(version)
+                if version_id is None:
+                    version_id = self._intern_version(version)
+                column[row] = version_id
+
+    def load_snapshot(self, path):
+        """
+        Restore the parsed contents of previous runs saved with save_snapshot().
+        Subsequent calls to fill_versions() only parse files whose content
+        has changed since then.
+        """
+        if not os.path.exists(path):
+            return False
+        try:
+            with open(path, 'rb') as f:
+                data = cPickle.load(f)
+            if data.get('format') != SNAPSHOT_FORMAT_VERSION:
+                raise ValueError('unsupported format %s' % data.get('format'))
+            if data.get('name_filter') != self._get_name_filter_key():
+                raise ValueError('different package name filter')
+        except Exception as e:
+            logging.warn("Ignoring apt data snapshot '%s': %s" % (path, e))
+            return False
+        logging.debug('Loaded apt data snapshot: %s' % path)
+        self.debian_packages = data['debian_packages']
+        self._columns = data['columns']
+        self._table = data['table']
+        self._versions = data['versions']
+        self._version_ids = dict([(v, i) for i, v in enumerate(self._versions)])
+        self._column_hashes = data['column_hashes']
+        self._filled_columns = set()
+        self._from_snapshot = True
+        self._modified = False
+        return True
+
+    def save_snapshot(self, path):
+        """
+        Save the parsed contents, together with the checksums of the files
+        they have been parsed from, to a binary snapshot.
+        Columns which have not been filled since the snapshot has been loaded
+        as well as packages which are not listed anymore are dropped.
+        """
+        if self._from_snapshot:
+            if not self._modified and len(self._filled_columns) == len(self._table):
+                logging.debug('Apt data snapshot is up-to-date: %s' % path)
+                return
+            self._compact()
+        data = {
+            'format': SNAPSHOT_FORMAT_VERSION,
+            'debian_packages': self.debian_packages,
+            'columns': self._columns,
+            'table': self._table,
+            'versions': self._versions,
+            'column_hashes': self._column_hashes,
+            'name_filter': self._get_name_filter_key(),
+        }
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            cPickle.dump(data, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+        logging.debug('Saved apt data snapshot: %s' % path)
+
+    def _get_name_filter_key(self):
+        return get_name_filter_key(self.name_filter)
+
+    def _compact(self):
+        column_indices = sorted(self._filled_columns)
+        old_table = [self._table[i] for i in column_indices]
+        rows = [row for row in xrange(len(self.debian_packages)) if any(column[row] for column in old_table)]
+
+        version_ids = {0: 0}
+        versions = [None]
+        for old_version_id in set([column[row] for column in old_table for row in rows]):
+            if old_version_id:
+                version_ids[old_version_id] = len(versions)
+                versions.append(self._versions[old_version_id])
+        self._table = [array('I', [version_ids[column[row]] for row in rows]) for column in old_table]
+        self._versions = versions
+        self._version_ids = dict([(v, i) for i, v in enumerate(versions)])
+
+        new_columns = dict([(old, new) for new, old in enumerate(column_indices)])
+        self._columns = dict([(key, new_columns[i]) for key, i in self._columns.items() if i in new_columns])
+        self._column_hashes = dict([(new_columns[i], h) for i, h in self._column_hashes.items() if i in new_columns])
+        self._filled_columns = set(new_columns.values())
+
+        names = dict([(row, name) for name, row in self.debian_packages.items()])
+        self.debian_packages = dict([(names[row], new_row) for new_row, row in enumerate(rows)])
+
+    def _get_column_index(self, repo_type, distro_arch):
+        key = (repo_type, distro_arch)
+        if key not in self._columns:
+            self._columns[key] = len(self._table)
+            self._table.append(array('I', [0]) * len(self.debian_packages))
+        return self._columns[key]
+
+    def _add_package(self, debian_name):
+        row = len(self.debian_packages)
+        self.debian_packages[debian_name] = row
+        for column in self._table:
+            column.append(0)
+        return row
+
+    def _intern_version(self, version):
+        version_id = len(self._versions)
+        self._versions.append(version)
+        self._version_ids[version] = version_id
+        return version_id
+
+
+def get_name_filter_key(name_filter):
+    """
+    Return a hashable representation of a name filter (see iter_stanzas()).
+    """
+    if name_filter is None:
+        return None
+    if hasattr(name_filter, 'pattern'):
+        return name_filter.pattern
+    return tuple(sorted(name_filter))
+
+
+def make_name_filter(prefixes):
+    """
+    Compile a matcher for package names starting with any of the prefixes,
+    e.g. ['ros-hydro-', 'ros-indigo-'].
+    """
+    return re.compile('|'.join([re.escape(p) for p in sorted(prefixes)]))
+
+
+def _get_stanza_matcher(name_filter):
+    """
+    Return a function checking if the paragraph starting at a position of a
+    buffer is for a package accepted by the name filter.
+    """
+    if name_filter is None:
+        return None
+    if hasattr(name_filter, 'match'):
+        offset = len('Package: ')
+
+        def match(buf, pos):
+            return buf.startswith('Package: ', pos) and name_filter.match(buf, pos + offset) is not None
+        return match
+    prefixes = tuple(['Package: ' + p for p in name_filter])
+    return lambda buf, pos: buf.startswith(prefixes, pos)
+
+
+def iter_stanzas(f, chunk_size=READ_CHUNK_SIZE, name_filter=None):
+    """
+    Iterate over the paragraphs of a deb822 formatted file object
+    (e.g. apt 'Packages' / 'Sources' list files).
+
+    The file is read in blocks of chunk_size bytes so that only the current
+    block and the paragraph being assembled are kept in memory.
+    If a name_filter (a list of package name prefixes or a compiled regular
+    expression matched against the beginning of the package name, see
+    make_name_filter()) is given, paragraphs of other packages are skipped
+    without being copied out of the read buffer.
+    """
+    match = _get_stanza_matcher(name_filter)
+    pending = ''
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        pending += chunk
+        start = 0
+        while True:
+            # skip additional empty lines between paragraphs
+            while pending.startswith('\n', start):
+                start += 1
+            end = pending.find('\n\n', start)
+            if end == -1:
+                break
+            if match is None or match(pending, start):
+                yield pending[start:end]
+            start = end + 2
+        pending = pending[start:]
+    pending = pending.strip('\n')
+    if pending and (match is None or match(pending, 0)):
+        yield pending
+
+
+def iter_package_versions(f, chunk_size=READ_CHUNK_SIZE, name_filter=None):
+    """
+    Iterate over the (package name, version) tuples of an apt 'Packages' /
+    'Sources' list file object.
+    The version is None if a paragraph does not contain exactly one version.
+    @see iter_stanzas() for the name_filter
+    """
+    package_prefix = 'Package: '
+    version_prefix = '\nVersion: '
+    for stanza in iter_stanzas(f, chunk_size=chunk_size, name_filter=name_filter):
+        assert stanza.startswith(package_prefix)
+        end = stanza.find('\n')
+        if end == -1:
+            end = len(stanza)
+        debian_name = stanza[len(package_prefix):end]
+
+        version = None
+        start = stanza.find(version_prefix)
+        if start != -1 and stanza.find(version_prefix, start + 1) == -1:
+            start += len(version_prefix)
+            end = stanza.find('\n', start)
+            version = stanza[start:end if end != -1 else len(stanza)]
+        yield debian_name, version
 
 
 def load_url(url, retry=2, retry_period=1, timeout=10):
-    try:
-        fh = urllib2.urlopen(url, timeout=timeout)
-    except urllib2.HTTPError as e:
-        if e.code == 503 and retry:
-            time.sleep(retry_period)
-            return load_url(url, retry=retry - 1, retry_period=retry_period, timeout=timeout)
-        e.msg += ' (%s)' % url
-        raise
-    except urllib2.URLError as e:
-        if isinstance(e.reason, socket.timeout) and retry:
-            time.sleep(retry_period)
-            return load_url(url, retry=retry - 1, retry_period=retry_period, timeout=timeout)
-        raise urllib2.URLError(str(e) + ' (%s)' % url)
-    return fh.read()
-
-
-def fetch_gzip_file(rootdir, repo_type, da_str, url, dst_filename, reuse_existing=False):
+    return open_url(url, retry=retry, retry_period=retry_period, timeout=timeout).read()
+
+
+def open_url(url, retry=2, retry_period=1, timeout=10):
+    return http_client.urlopen(url, retry=retry, retry_period=retry_period, timeout=timeout)
+
+
+def get_release_hashes(repo_url, distro):
+    """
+    Fetch the 'InRelease' (or 'Release') file of a distro and return the
+    SHA256 checksums of the listed files as a dict mapping the path relative
+    to the distro (e.g. 'main/binary-amd64/Packages.gz') to (sha256, size).
+    """
+    for filename in ['InRelease', 'Release']:
+        url = os.path.join(repo_url, 'dists/%s/%s' % (distro, filename))
+        try:
+            data = load_url(url)
+        except urllib2.HTTPError as e:
+            if e.code == 404:
+                continue
+            raise
+        return parse_release_hashes(data)
+    logging.warn("Neither 'InRelease' nor 'Release' found for '%s' in '%s'" % (distro, repo_url))
+    return {}
+
+
+def parse_release_hashes(data):
+    """
+    Extract the entries of the 'SHA256' field of a (clear signed) Release file.
+    """
+    hashes = {}
+    in_sha256 = False
+    for line in data.splitlines():
+        if line.startswith(' '):
+            if in_sha256:
+                parts = line.split()
+                if len(parts) == 3:
+                    hashes[parts[2]] = (parts[0], int(parts[1]))
+        else:
+            in_sha256 = line.rstrip() == 'SHA256:'
+    return hashes
+
+
+def fetch_gzip_file(rootdir, repo_type, da_str, url, dst_filename, reuse_existing=False, expected_sha256=None, use_pdiff=False):
+    """
+    Download and decompress an apt list file.
+    The compression (gzip, bzip2 or xz) is determined by the extension of
+    the url. The data is decompressed while being downloaded and the file is
+    replaced atomically.
+
+    If expected_sha256 is given and the checksum of the previously downloaded
+    file matches it the existing file is reused.
+    If use_pdiff is set an existing file is updated with the incremental
+    patches from the repository if possible.
+    """
     path = os.path.join(rootdir, repo_type, da_str)
     if not os.path.exists(path):
-        os.makedirs(path)
+        try:
+            os.makedirs(path)
+        except OSError:
+            # the directory might have been created concurrently
+            if not os.path.isdir(path):
+                raise
     path = os.path.join(path, dst_filename)
-    if not reuse_existing or not os.path.exists(path):
-        logging.debug('Downloading apt list file: %s' % url)
-        yaml_gz_str = load_url(url)
-        yaml_gz_stream = StringIO(yaml_gz_str)
-        g = gzip.GzipFile(fileobj=yaml_gz_stream, mode='rb')
-        with open(path, 'w') as f:
-            f.write(g.read())
-    else:
+    sha256_path = path + '.sha256'
+    if expected_sha256 and os.path.exists(path) and _read_sha256(sha256_path) == expected_sha256:
+        logging.debug('Reuse unchanged apt list file: %s' % path)
+    elif reuse_existing and os.path.exists(path):
         logging.debug('Reuse apt list file: %s' % path)
+    elif use_pdiff and os.path.exists(path) and _update_with_pdiff(path, url):
+        # the patched file has been verified against the diff index of the
+        # Release file, so it corresponds to the listed compressed file
+        _write_sha256(sha256_path, expected_sha256)
+    else:
+        logging.debug('Downloading apt list file: %s' % url)
+        # invalidate the checksum of the previous file before replacing it
+        _write_sha256(sha256_path, None)
+        sha256 = _download_and_decompress(url, path)
+        if expected_sha256 and sha256 != expected_sha256:
+            # the repository has likely been updated in the meantime
+            logging.warn("Checksum of '%s' does not match the Release file" % url)
+            sha256 = None
+        _write_sha256(sha256_path, sha256)
     return path
+
+
+def _download_and_decompress(url, path):
+    """
+    Stream the compressed file from url through a decompressor into a
+    temporary file which finally replaces path.
+    @return: the SHA256 of the compressed file
+    """
+    ext = os.path.splitext(url)[1]
+    if ext == '.gz':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif ext == '.bz2':
+        decompressor = bz2.BZ2Decompressor()
+    elif ext == '.xz' and lzma:
+        decompressor = lzma.LZMADecompressor()
+    else:
+        raise ValueError("Unsupported compression of apt list file '%s'" % url)
+
+    sha256 = hashlib.sha256()
+    fh = open_url(url)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = fh.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                sha256.update(chunk)
+                f.write(decompressor.decompress(chunk))
+            if hasattr(decompressor, 'flush'):
+                f.write(decompressor.flush())
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    finally:
+        fh.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return sha256.hexdigest()
+
+
+def _update_with_pdiff(path, url):
+    # invalidate the checksum of the previous file before patching it
+    _write_sha256(path + '.sha256', None)
+    diff_index_url = get_diff_index_url(url)
+    logging.debug('Updating apt list file using the diff index: %s' % diff_index_url)
+    if update_with_pdiff(path, diff_index_url, load_url):
+        return True
+    logging.debug('Falling back to downloading the complete apt list file')
+    return False
+
+
+def _hash_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _read_sha256(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return f.read().strip()
+
+
+def _write_sha256(path, sha256):
+    if not sha256:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    with open(path, 'w') as f:
+        f.write('%s\n' % sha256)
@@ -2,7 +2,6 @@
 
 from __future__ import print_function
 
-from distutils.version import LooseVersion
 import itertools
 from StringIO import StringIO
 
@@ -10,10 +9,20 @@ from rosdistro import get_cached_distribution
 
 # Monkey-patching over some unicode bugs in empy
 # is implicitly done by importing status_page module
-from .status_page import em, get_resource_hashes
+from .debian_version import get_upstream_numbers
+from .status_page import get_resource_hashes, render_template
 
 
 def generate_html(index, distro_names, start_time, template_file, resource_path):
+    output = StringIO()
+    write_html(output, index, distro_names, start_time, template_file, resource_path)
+    return output.getvalue()
+
+
+def write_html(f, index, distro_names, start_time, template_file, resource_path):
+    """
+    Render the compare page to the file object f.
+    """
     headers = ['Repo', 'Maintainer'] + [d[0].upper() + d[1:].lower() for d in distro_names]
     distros = [get_cached_distribution(index, d) for d in distro_names]
     repos = {}
@@ -33,13 +42,7 @@ def generate_html(index, distro_names, start_time, template_file, resource_path)
 
     resource_hashes = get_resource_hashes()
 
-    output = StringIO()
-    try:
-        interpreter = em.Interpreter(output=output)
-        interpreter.file(open(template_file), locals=locals())
-        return output.getvalue()
-    finally:
-        interpreter.shutdown()
+    render_template(template_file, f, locals())
 
 
 class Row(object):
@@ -67,7 +70,7 @@ class Row(object):
         return ' '.join([self.maintainers[k] for k in sorted(self.maintainers.keys())])
 
     def get_labels(self, distros):
-        all_versions = [LooseVersion(v) if v else v for v in self.versions]
+        all_versions = [get_upstream_numbers(v) if v else v for v in self.versions]
         valid_versions = [v for v in all_versions if v]
         labels = []
         if any([_is_only_patch_is_different(p[0], p[1]) for p in itertools.combinations(valid_versions, 2)]):
@@ -82,11 +85,11 @@ class Row(object):
 
 
 def _is_only_patch_is_different(a, b):
-    return a.version[0] == b.version[0] and a.version[1] == b.version[1] and a.version[2] != b.version[2]
+    return a[:2] == b[:2] and a[2:3] != b[2:3]
 
 
 def _is_greater(a, b):
-    return a.version[0] > b.version[0] or (a.version[0] == b.version[0] and a.version[1] > b.version[1])
+    return a[:2] > b[:2]
 
 
 def _is_same_version_but_different_branch(version_a, version_b, branch_a, branch_b):
@@ -96,7 +99,7 @@ def _is_same_version_but_different_branch(version_a, version_b, branch_a, branch
     # skip when any branch is unknown or they are equal
     if not branch_a or not branch_b or branch_a == branch_b:
         return False
-    return version_a.version[0] == version_b.version[0] and version_a.version[1] == version_b.version[1]
+    return version_a[:2] == version_b[:2]
 
 
 def format_row(repo_name, distros):
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+"""
+Ordering of Debian package versions ([epoch:]upstream_version[-revision])
+as implemented by dpkg.
+
+The versions are converted into sort keys which can be compared with the
+builtin comparison operators. The keys are cached so that repeatedly
+comparing the same version strings only costs dictionary lookups.
+"""
+
+from __future__ import print_function
+
+import re
+
+MAX_CACHE_SIZE = 100000
+
+_segment_rx = re.compile(r'(\D*)(\d*)')
+_digits_rx = re.compile(r'\d+')
+
+_sort_keys = {}
+_upstream_numbers = {}
+
+# key of an empty non-digit segment, also terminating every part
+_EMPTY = (1,)
+
+
+def _char_weight(c):
+    # '~' sorts before anything, even the end of a segment,
+    # letters sort before all other characters
+    if c == '~':
+        return 0
+    if c.isalpha():
+        return 2 + ord(c)
+    return 2 + 256 + ord(c)
+
+
+def _get_part_key(part):
+    key = []
+    for non_digits, digits in _segment_rx.findall(part):
+        if not non_digits and not digits:
+            continue
+        key.append(tuple([_char_weight(c) for c in non_digits]) + _EMPTY)
+        key.append(int(digits) if digits else 0)
+    # trailing empty segments don't affect the order (e.g. '1.0' == '1.0-0')
+    while len(key) >= 2 and key[-2] == _EMPTY and key[-1] == 0:
+        del key[-2:]
+    # dpkg compares a shorter part as if it were padded with empty
+    # segments: the following non-digit segment of a longer key decides
+    # (lower if it starts with '~', greater otherwise). Only the first
+    # non-digit segment can be empty, in which case its number decides
+    # before the next non-digit segment.
+    return tuple(key) + (_EMPTY, 0, _EMPTY)
+
+
+def split_version(version):
+    """
+    Split a Debian version into its epoch, upstream version and revision.
+    """
+    epoch = 0
+    if ':' in version:
+        epoch, version = version.split(':', 1)
+        epoch = int(epoch) if epoch.isdigit() else 0
+    revision = ''
+    if '-' in version:
+        version, revision = version.rsplit('-', 1)
+    return epoch, version, revision
+
+
+def get_sort_key(version):
+    """
+    Return a key of the version which orders like dpkg --compare-versions.
+    """
+    try:
+        return _sort_keys[version]
+    except KeyError:
+        pass
+    epoch, upstream, revision = split_version(version)
+    key = (epoch, _get_part_key(upstream), _get_part_key(revision))
+    if len(_sort_keys) >= MAX_CACHE_SIZE:
+        _sort_keys.clear()
+    _sort_keys[version] = key
+    return key
+
+
+def compare_versions(a, b):
+    """
+    Compare two Debian versions.
+    @return: a negative number if a is lower than b, zero if they are equal
+      and a positive number if a is greater than b
+
+    >>> compare_versions('1.0', '1.0-0')
+    0
+    >>> compare_versions('1.0~rc1', '1.0')
+    -1
+    >>> compare_versions('1.0', '1.0-0~')
+    1
+    >>> compare_versions('1.0-0', '1.0-0~')
+    1
+    >>> compare_versions('1.0~~', '1.0~')
+    -1
+    >>> compare_versions('1:0.9', '2.0')
+    1
+    >>> compare_versions('0:2.0', '2.0')
+    0
+    >>> compare_versions('1.0a', '1.0+')
+    -1
+    >>> compare_versions('1.0a', '1.0')
+    1
+    >>> compare_versions('1.2.3-0precise-20130601', '1.2.3-0precise')
+    1
+    >>> compare_versions('1.10', '1.9')
+    1
+    """
+    if a == b:
+        return 0
+    return cmp(get_sort_key(a), get_sort_key(b))
+
+
+def get_upstream_numbers(version):
+    """
+    Return the numbers of the upstream version, e.g. (1, 2, 3) for
+    '1:1.2.3-0precise'.
+    """
+    try:
+        return _upstream_numbers[version]
+    except KeyError:
+        pass
+    numbers = tuple([int(n) for n in _digits_rx.findall(split_version(version)[1])])
+    if len(_upstream_numbers) >= MAX_CACHE_SIZE:
+        _upstream_numbers.clear()
+    _upstream_numbers[version] = numbers
+    return numbers
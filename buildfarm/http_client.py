@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+
+"""
+Shared HTTP client for fetching repository indices and metadata.
+
+Connections are kept alive and reused per host, responses are requested
+with gzip transfer encoding, failed requests are retried with an
+exponential backoff and the transferred bytes and latency of every request
+are recorded so that they can be dumped at the end of a run.
+"""
+
+from __future__ import print_function
+
+import base64
+import httplib
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+import zlib
+
+DEFAULT_TIMEOUT = 10
+READ_CHUNK_SIZE = 64 * 1024
+MAX_REDIRECTS = 5
+REDIRECT_CODES = [301, 302, 303, 307, 308]
+# status codes of responses which are worth retrying
+RETRY_CODES = [500, 502, 503, 504]
+# extensions of resources which are not compressed again for the transfer
+COMPRESSED_EXTENSIONS = ['.gz', '.bz2', '.xz', '.lzma']
+
+
+class RequestRecord(object):
+
+    def __init__(self, url, code, num_bytes, seconds, attempts):
+        self.url = url
+        self.code = code
+        # number of bytes transferred (before decoding the transfer encoding)
+        self.bytes = num_bytes
+        self.seconds = seconds
+        self.attempts = attempts
+
+
+class HttpClient(object):
+
+    def __init__(self, max_idle_connections=4):
+        self.max_idle_connections = max_idle_connections
+        self.records = []
+        self._idle_connections = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def fetch(self, url, **kwargs):
+        """
+        Return the content of an url.
+        @see urlopen() for the keyword arguments
+        """
+        response = self.urlopen(url, **kwargs)
+        try:
+            return response.read()
+        finally:
+            response.close()
+
+    def urlopen(self, url, timeout=DEFAULT_TIMEOUT, retry=2, retry_period=1, headers=None):
+        """
+        Open an url and return a file-like response object.
+        Failed requests are retried up to retry times, waiting retry_period
+        seconds before the first retry and doubling the period every time.
+        Urls with other schemes than http(s) are passed to urllib2.
+        @raise urllib2.HTTPError: if the server responds with an error, a
+          redirect without location or too many redirects
+        @raise urllib2.URLError: if the url can not be fetched
+        """
+        if urlparse.urlsplit(url).scheme not in ['http', 'https']:
+            return urllib2.urlopen(url, timeout=timeout)
+
+        start_time = time.time()
+        attempt = 0
+        redirects = 0
+        while True:
+            attempt += 1
+            try:
+                response = self._request(url, timeout, headers or {}, start_time, attempt)
+            except (httplib.HTTPException, socket.error) as e:
+                if attempt <= retry:
+                    self._wait(url, e, attempt, retry_period)
+                    continue
+                self._record(url, None, 0, start_time, attempt)
+                raise urllib2.URLError('%s (%s)' % (e, url))
+
+            if response.code in REDIRECT_CODES:
+                location = response.headers.getheader('location')
+                response.discard()
+                if not location:
+                    raise urllib2.HTTPError(url, response.code, 'Redirect without location (%s)' % url,
+                                            response.headers, None)
+                if redirects >= MAX_REDIRECTS:
+                    raise urllib2.HTTPError(url, response.code, 'Too many redirects (%s)' % url,
+                                            response.headers, None)
+                redirects += 1
+                url = urlparse.urljoin(url, location)
+                continue
+            if response.code in RETRY_CODES and attempt <= retry:
+                response.discard()
+                self._wait(url, 'HTTP %d' % response.code, attempt, retry_period)
+                continue
+            if response.code >= 400:
+                response.discard()
+                raise urllib2.HTTPError(url, response.code, '%s (%s)' % (response.msg, url), response.headers, None)
+            return response
+
+    def dump_stats(self, stream=sys.stdout, verbose=False):
+        """
+        Print the number of requests, transferred bytes and the accumulated
+        latency per host.
+        """
+        hosts = {}
+        for record in self.records:
+            host = urlparse.urlsplit(record.url).netloc
+            stats = hosts.setdefault(host, [0, 0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += record.attempts - 1
+            stats[2] += record.bytes
+            stats[3] += record.seconds
+        print('HTTP statistics:', file=stream)
+        for host in sorted(hosts.keys()):
+            requests, retries, num_bytes, seconds = hosts[host]
+            print('  %s: %d requests (%d retries), %.1f KiB, %.2f s' %
+                  (host, requests, retries, num_bytes / 1024.0, seconds), file=stream)
+        if verbose:
+            for record in self.records:
+                print('  %s %s: %d bytes, %.3f s' %
+                      (record.code, record.url, record.bytes, record.seconds), file=stream)
+
+    def reset_stats(self):
+        """
+        Forget the recorded requests (e.g. between runs of a long-running
+        process).
+        """
+        with self._lock:
+            self.records = []
+
+    def _request(self, url, timeout, headers, start_time, attempt):
+        parts = urlparse.urlsplit(url)
+        key, path, proxy_headers = self._get_connection_key(parts)
+        # decoding an already compressed resource which is (wrongly) labelled
+        # with a content encoding would return the uncompressed content
+        encoding = 'gzip'
+        if os.path.splitext(parts.path)[1] in COMPRESSED_EXTENSIONS:
+            encoding = 'identity'
+        request_headers = {'Accept-Encoding': encoding}
+        request_headers.update(proxy_headers)
+        request_headers.update(headers)
+
+        conn = self._get_connection(key, timeout)
+        try:
+            conn.request('GET', path, headers=request_headers)
+            raw_response = conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            if not getattr(conn, '_buildfarm_reused', False):
+                raise
+            # a kept alive connection might have been closed by the server
+            conn = self._get_connection(key, timeout, reuse=False)
+            try:
+                conn.request('GET', path, headers=request_headers)
+                raw_response = conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                raise
+        decode = request_headers['Accept-Encoding'] != 'identity'
+        return Response(self, url, key, conn, raw_response, start_time, attempt, decode)
+
+    def _get_connection_key(self, parts):
+        """
+        @return: the key of the connection (scheme, host, tunneled host,
+          headers of the tunnel request), the path to request and the
+          headers for the proxy
+        """
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        proxy = urllib.getproxies().get(parts.scheme)
+        if not proxy or urllib.proxy_bypass(parts.hostname):
+            return (parts.scheme, parts.netloc, None, ()), path, {}
+        proxy_parts = urlparse.urlsplit(proxy)
+        proxy_netloc = proxy_parts.hostname
+        if proxy_parts.port:
+            proxy_netloc += ':%d' % proxy_parts.port
+        proxy_headers = {}
+        if proxy_parts.username:
+            credentials = '%s:%s' % (urllib.unquote(proxy_parts.username),
+                                     urllib.unquote(proxy_parts.password or ''))
+            proxy_headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials)
+        if parts.scheme == 'https':
+            # tunnel the encrypted connection through the proxy, the
+            # credentials are only sent with the CONNECT request
+            return ('https', proxy_netloc, parts.netloc, tuple(proxy_headers.items())), path, {}
+        return ('http', proxy_netloc, None, ()), urlparse.urlunsplit(parts[:4] + ('',)), proxy_headers
+
+    def _get_connection(self, key, timeout, reuse=True):
+        if reuse:
+            with self._lock:
+                if self._pid != os.getpid():
+                    # never share connections with the parent of a forked process
+                    self._idle_connections = {}
+                    self._pid = os.getpid()
+                connections = self._idle_connections.get(key)
+                if connections:
+                    conn = connections.pop()
+                    conn.timeout = timeout
+                    if conn.sock:
+                        conn.sock.settimeout(timeout)
+                    return conn
+        scheme, netloc, tunnel_netloc, tunnel_headers = key
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(netloc, timeout=timeout)
+        else:
+            conn = httplib.HTTPConnection(netloc, timeout=timeout)
+        if tunnel_netloc:
+            conn.set_tunnel(tunnel_netloc, headers=dict(tunnel_headers))
+        return conn
+
+    def _release_connection(self, key, conn):
+        conn._buildfarm_reused = True
+        with self._lock:
+            if self._pid != os.getpid():
+                conn.close()
+                return
+            connections = self._idle_connections.setdefault(key, [])
+            if len(connections) < self.max_idle_connections:
+                connections.append(conn)
+                return
+        conn.close()
+
+    def _record(self, url, code, num_bytes, start_time, attempts):
+        record = RequestRecord(url, code, num_bytes, time.time() - start_time, attempts)
+        with self._lock:
+            self.records.append(record)
+        logging.debug('Fetched %s: %s, %d bytes, %.3f s' % (url, code, num_bytes, record.seconds))
+
+    def _wait(self, url, reason, attempt, retry_period):
+        period = retry_period * 2 ** (attempt - 1)
+        logging.debug("Retrying '%s' in %.1f s: %s" % (url, period, reason))
+        time.sleep(period)
+
+
+class Response(object):
+    """
+    File-like object for a response which returns its connection to the pool
+    once the content has been read completely.
+    """
+
+    def __init__(self, client, url, key, conn, raw_response, start_time, attempts, decode=True):
+        self.url = url
+        self.code = raw_response.status
+        self.msg = raw_response.reason
+        self.headers = raw_response.msg
+        self._client = client
+        self._key = key
+        self._conn = conn
+        self._raw_response = raw_response
+        self._start_time = start_time
+        self._attempts = attempts
+        self._bytes = 0
+        self._decompressor = None
+        if decode and (self.headers.getheader('content-encoding') or '').lower() == 'gzip':
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._buffer = ''
+        self._done = False
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.code
+
+    def geturl(self):
+        return self.url
+
+    def read(self, size=-1):
+        if size < 0:
+            chunks = [self._buffer]
+            while not self._done:
+                chunks.append(self._read_chunk())
+            self._buffer = ''
+            return ''.join(chunks)
+        while not self._done and len(self._buffer) < size:
+            self._buffer += self._read_chunk()
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def discard(self):
+        """
+        Drop the remaining content of a short response (e.g. redirects and
+        errors) so that the connection can be reused.
+        """
+        try:
+            while not self._done and self._bytes < READ_CHUNK_SIZE:
+                self._read_chunk()
+        except urllib2.URLError:
+            pass
+        self.close()
+
+    def close(self):
+        if self._done:
+            return
+        self._done = True
+        self._raw_response.close()
+        self._conn.close()
+        self._client._record(self.url, self.code, self._bytes, self._start_time, self._attempts)
+
+    def _read_chunk(self):
+        try:
+            chunk = self._raw_response.read(READ_CHUNK_SIZE)
+        except (httplib.HTTPException, socket.error) as e:
+            self.close()
+            raise urllib2.URLError('%s (%s)' % (e, self.url))
+        self._bytes += len(chunk)
+        data = self._decompressor.decompress(chunk) if self._decompressor else chunk
+        if not chunk:
+            if self._decompressor:
+                data += self._decompressor.flush()
+            self._done = True
+            if self._raw_response.will_close:
+                self._conn.close()
+            else:
+                self._client._release_connection(self._key, self._conn)
+            self._client._record(self.url, self.code, self._bytes, self._start_time, self._attempts)
+        return data
+
+
+_client = HttpClient()
+
+
+def get_client():
+    return _client
+
+
+def fetch(url, **kwargs):
+    return _client.fetch(url, **kwargs)
+
+
+def urlopen(url, **kwargs):
+    return _client.urlopen(url, **kwargs)
+
+
+def dump_stats(stream=sys.stdout, verbose=False):
+    _client.dump_stats(stream=stream, verbose=verbose)
+
+
+def reset_stats():
+    _client.reset_stats()
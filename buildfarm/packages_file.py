@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+"""
+Lookups of the packages of stored apt list files ('Packages' / 'Sources')
+through a sidecar index mapping every package name to the byte offsets and
+lengths of its paragraphs. The index is written when a file is opened for
+the first time after it has changed.
+"""
+
+from __future__ import print_function
+
+import cPickle
+import logging
+import os
+
+INDEX_SUFFIX = '.index'
+INDEX_FORMAT_VERSION = 1
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+def iter_stanza_offsets(f, chunk_size=READ_CHUNK_SIZE):
+    """
+    Iterate over the (package name, offset, length) tuples of the paragraphs
+    of a deb822 formatted file object.
+    """
+    package_prefix = 'Package: '
+    pending = ''
+    # file offset of the beginning of pending
+    base = 0
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        pending += chunk
+        start = 0
+        while True:
+            while pending.startswith('\n', start):
+                start += 1
+            end = pending.find('\n\n', start)
+            if end == -1:
+                break
+            if pending.startswith(package_prefix, start):
+                name_end = pending.find('\n', start)
+                yield pending[start + len(package_prefix):name_end], base + start, end - start
+            start = end + 2
+        pending = pending[start:]
+        base += start
+    # the last paragraph might not be terminated by an empty line
+    end = len(pending.rstrip('\n'))
+    if end and pending.startswith(package_prefix):
+        name_end = pending.find('\n', 0, end)
+        if name_end == -1:
+            name_end = end
+        yield pending[len(package_prefix):name_end], base, end
+
+
+def write_index(path):
+    """
+    Scan the apt list file at path and store the offsets of its paragraphs in
+    the sidecar index file.
+    @return: the index as a dict mapping package names to lists of
+      (offset, length) tuples
+    """
+    stat = os.stat(path)
+    packages = {}
+    with open(path, 'rb') as f:
+        for name, offset, length in iter_stanza_offsets(f):
+            packages.setdefault(name, []).append((offset, length))
+    data = {
+        'format': INDEX_FORMAT_VERSION,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'packages': packages,
+    }
+    index_path = path + INDEX_SUFFIX
+    tmp_path = '%s.%d.tmp' % (index_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        cPickle.dump(data, f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_path, index_path)
+    logging.debug("Indexed %d packages of '%s'" % (len(packages), path))
+    return packages
+
+
+def read_index(path):
+    """
+    Load the sidecar index of the apt list file at path.
+    @return: the index (see write_index()) or None if it is missing or
+      outdated
+    """
+    index_path = path + INDEX_SUFFIX
+    if not os.path.exists(index_path):
+        return None
+    try:
+        with open(index_path, 'rb') as f:
+            data = cPickle.load(f)
+    except Exception as e:
+        logging.warn("Ignoring invalid index '%s': %s" % (index_path, e))
+        return None
+    stat = os.stat(path)
+    if data.get('format') != INDEX_FORMAT_VERSION or \
+            data.get('size') != stat.st_size or data.get('mtime') != stat.st_mtime:
+        return None
+    return data['packages']
+
+
+def update_index(path):
+    """
+    Write the sidecar index of the apt list file at path unless it is
+    up-to-date.
+    """
+    packages = read_index(path)
+    if packages is None:
+        packages = write_index(path)
+    return packages
+
+
+class PackagesFile(object):
+    """
+    Stored apt list file whose packages are looked up in its sidecar index
+    without reading the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._index = update_index(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, debian_name):
+        return debian_name in self._index
+
+    def close(self):
+        self._index = {}
+
+    def get_names(self):
+        return self._index.keys()
+
+    def count(self, prefix=''):
+        """
+        Return the number of paragraphs of packages whose name starts with
+        prefix.
+        """
+        return sum([len(v) for n, v in self._index.iteritems() if n.startswith(prefix)])
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+"""
+Incremental updates of apt list files using the 'Packages.diff/Index'
+(pdiff) scheme: instead of downloading the complete list the ed-style
+patches published by the repository are applied to the local copy.
+"""
+
+from __future__ import print_function
+
+import gzip
+import hashlib
+import logging
+import os
+import re
+from StringIO import StringIO
+import urllib2
+
+_ed_command_rx = re.compile(r'^(\d+)(?:,(\d+))?([acd])$')
+
+
+class PdiffError(Exception):
+    pass
+
+
+def get_diff_index_url(url):
+    """
+    Return the url of the diff index for the url of a (compressed) list file,
+    e.g. '.../binary-amd64/Packages.gz' -> '.../binary-amd64/Packages.diff/Index'.
+    """
+    base, ext = os.path.splitext(url)
+    if ext not in ['.gz', '.bz2', '.xz']:
+        base = url
+    return base + '.diff/Index'
+
+
+def parse_diff_index(data):
+    """
+    Parse the content of a diff index.
+    @return: dict with the used 'hash' algorithm, the 'current' (hash, size),
+      the 'history' as a list of (hash, size, patch name), the 'patches' and
+      the compressed 'downloads' as dicts mapping the patch name to
+      (hash, size) and if the patches are 'merged' (each patch leads
+      directly to the current version)
+    """
+    fields = {}
+    field = None
+    for line in data.splitlines():
+        if not line.strip():
+            continue
+        if line.startswith(' '):
+            if field is None:
+                raise PdiffError('Continuation line without field: %s' % line)
+            fields[field].append(line.split())
+        else:
+            field, _, value = line.partition(':')
+            fields[field] = []
+            value = value.strip()
+            if value:
+                fields[field].append(value.split())
+
+    for hash_name in ['SHA256', 'SHA1']:
+        if '%s-Current' % hash_name in fields:
+            break
+    else:
+        raise PdiffError('Diff index without supported checksums')
+
+    try:
+        current = fields['%s-Current' % hash_name][0]
+        index = {
+            'hash': hash_name.lower(),
+            'current': (current[0], int(current[1])),
+            'history': [(h, int(s), n) for h, s, n in fields.get('%s-History' % hash_name, [])],
+            'patches': dict([(n, (h, int(s))) for h, s, n in fields.get('%s-Patches' % hash_name, [])]),
+            'downloads': {},
+            'merged': fields.get('X-Patch-Precedence', [[None]])[0][0] == 'merged',
+        }
+        for h, s, n in fields.get('%s-Download' % hash_name, []):
+            if n.endswith('.gz'):
+                index['downloads'][n[:-3]] = (h, int(s))
+    except (IndexError, ValueError) as e:
+        raise PdiffError('Malformed diff index: %s' % e)
+    return index
+
+
+def apply_ed_patch(lines, patch):
+    """
+    Apply an ed script as generated by 'diff --ed' to a list of lines
+    (including their line endings) in place.
+    """
+    patch_lines = patch.splitlines(True)
+    i = 0
+    while i < len(patch_lines):
+        command = patch_lines[i].rstrip('\n')
+        i += 1
+        match = _ed_command_rx.match(command)
+        if not match:
+            raise PdiffError("Unsupported ed command '%s'" % command)
+        start = int(match.group(1))
+        end = int(match.group(2) or start)
+        op = match.group(3)
+        if end > len(lines) or (op != 'a' and start < 1):
+            raise PdiffError("Ed command '%s' exceeds %d lines" % (command, len(lines)))
+
+        new_lines = []
+        if op in ['a', 'c']:
+            while True:
+                if i >= len(patch_lines):
+                    raise PdiffError("Unterminated ed command '%s'" % command)
+                line = patch_lines[i]
+                i += 1
+                if line.rstrip('\n') == '.':
+                    break
+                new_lines.append(line)
+
+        if op == 'a':
+            lines[start:start] = new_lines
+        else:
+            lines[start - 1:end] = new_lines
+
+
+def update_with_pdiff(path, diff_index_url, load_url):
+    """
+    Update the list file at path by applying the patches from the diff index.
+    The updated file is only written if its checksum matches the one of the
+    current list in the diff index.
+    @param load_url: function returning the content of an url
+    @return: True if the file is up-to-date, False if it could not be
+      updated and needs to be downloaded completely
+    """
+    try:
+        index = parse_diff_index(load_url(diff_index_url))
+    except (urllib2.URLError, PdiffError) as e:
+        logging.debug("Failed to fetch diff index '%s': %s" % (diff_index_url, e))
+        return False
+
+    with open(path, 'r') as f:
+        content = f.read()
+    local_hash = hashlib.new(index['hash'], content).hexdigest()
+    if local_hash == index['current'][0]:
+        logging.debug('Apt list file is up-to-date: %s' % path)
+        return True
+
+    history_hashes = [h for h, _, _ in index['history']]
+    if local_hash not in history_hashes:
+        logging.debug("Apt list file '%s' is not part of the diff history" % path)
+        return False
+    start = history_hashes.index(local_hash)
+    if index['merged']:
+        patch_names = [index['history'][start][2]]
+    else:
+        patch_names = [n for _, _, n in index['history'][start:]]
+
+    base_url = diff_index_url[:-len('Index')]
+    lines = content.splitlines(True)
+    del content
+    try:
+        for patch_name in patch_names:
+            patch = _load_patch(base_url + patch_name + '.gz', index['hash'],
+                                index['downloads'].get(patch_name),
+                                index['patches'].get(patch_name), load_url)
+            apply_ed_patch(lines, patch)
+    except (urllib2.URLError, IOError, PdiffError) as e:
+        logging.debug("Failed to apply patches to '%s': %s" % (path, e))
+        return False
+
+    content = ''.join(lines)
+    if hashlib.new(index['hash'], content).hexdigest() != index['current'][0]:
+        logging.debug("Patched apt list file '%s' does not match the diff index" % path)
+        return False
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.rename(tmp_path, path)
+    logging.debug('Applied %d patches to apt list file: %s' % (len(patch_names), path))
+    return True
+
+
+def _load_patch(url, hash_name, download_hash, patch_hash, load_url):
+    data = load_url(url)
+    if download_hash and hashlib.new(hash_name, data).hexdigest() != download_hash[0]:
+        raise PdiffError("Checksum mismatch of '%s'" % url)
+    patch = gzip.GzipFile(fileobj=StringIO(data), mode='rb').read()
+    if patch_hash and hashlib.new(hash_name, patch).hexdigest() != patch_hash[0]:
+        raise PdiffError("Checksum mismatch of uncompressed '%s'" % url)
+    return patch
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+"""
+Pre-compressed copies of generated files which web servers can serve
+directly (e.g. nginx with gzip_static / brotli_static).
+"""
+
+from __future__ import print_function
+
+import gzip
+import logging
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP_SUFFIX = '.gz'
+BROTLI_SUFFIX = '.br'
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+def _write_gzip(path, dst_path, name):
+    with open(path, 'rb') as src:
+        with open(dst_path, 'wb') as f:
+            # a fixed mtime makes the output only depend on the content
+            gz = gzip.GzipFile(name, 'wb', 9, f, mtime=0)
+            try:
+                while True:
+                    chunk = src.read(READ_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    gz.write(chunk)
+            finally:
+                gz.close()
+
+
+def _write_brotli(path, dst_path, name):
+    with open(path, 'rb') as src:
+        data = src.read()
+    with open(dst_path, 'wb') as f:
+        f.write(brotli.compress(data, mode=brotli.MODE_TEXT))
+
+
+def compress_file(path, use_brotli=False, dst_path=None):
+    """
+    Write compressed copies of the file next to it (<path>.gz and
+    optionally <path>.br). Each copy replaces the previous one atomically.
+    A brotli copy of a previous run is removed if use_brotli is False since
+    it would be outdated.
+    @param dst_path: the path to write the copies for instead of path (e.g.
+      the final path of a temporary file, see replace_file())
+    @return: list of the written paths
+    @raise RuntimeError: if use_brotli is True but brotli is not installed
+    """
+    if use_brotli and brotli is None:
+        raise RuntimeError("Brotli compression requires the 'brotli' module")
+    if dst_path is None:
+        dst_path = path
+    writers = [(GZIP_SUFFIX, _write_gzip)]
+    if use_brotli:
+        writers.append((BROTLI_SUFFIX, _write_brotli))
+    elif os.path.exists(dst_path + BROTLI_SUFFIX):
+        os.remove(dst_path + BROTLI_SUFFIX)
+
+    written = []
+    for suffix, writer in writers:
+        compressed_path = dst_path + suffix
+        tmp_path = '%s.%d.tmp' % (compressed_path, os.getpid())
+        writer(path, tmp_path, os.path.basename(dst_path))
+        os.rename(tmp_path, compressed_path)
+        logging.debug("Compressed '%s' to %d bytes" % (compressed_path, os.path.getsize(compressed_path)))
+        written.append(compressed_path)
+    return written
+
+
+def replace_file(tmp_path, path, compress=False, use_brotli=False):
+    """
+    Rename the completely written file tmp_path to path.
+    If compress is True the compressed copies of path are written before,
+    so that servers never serve the copies of the previous file next to the
+    new one.
+    @see compress_file()
+    """
+    if compress:
+        compress_file(tmp_path, use_brotli=use_brotli, dst_path=path)
+    os.rename(tmp_path, path)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""
+Detection of republished apt repositories by polling the Release files of
+their distros with conditional requests, so that unchanged files are not
+transferred.
+"""
+
+from __future__ import print_function
+
+import hashlib
+import logging
+import os
+import urllib2
+
+from . import http_client
+
+RELEASE_FILENAMES = ['InRelease', 'Release']
+
+
+class ReleaseWatcher(object):
+
+    def __init__(self, repo_urls, distros, client=None):
+        self.client = client or http_client.get_client()
+        self.targets = [(repo_url, distro) for repo_url in repo_urls for distro in distros]
+        # the url, validators and digest of the last response for each target
+        # and whether a failure to poll it has been reported
+        self._states = {}
+
+    def poll(self):
+        """
+        Request the Release file of each distro of each repo.
+        @return: list of (repo_url, distro) tuples whose Release file has
+          changed since the previous poll (all of them on the first poll)
+        """
+        return [target for target in self.targets if self._poll(target)]
+
+    def _poll(self, target):
+        repo_url, distro = target
+        state = self._states.setdefault(target, {})
+        filenames = [state['filename']] if 'filename' in state else RELEASE_FILENAMES
+        for filename in filenames:
+            url = os.path.join(repo_url, 'dists/%s/%s' % (distro, filename))
+            headers = {}
+            if state.get('etag'):
+                headers['If-None-Match'] = state['etag']
+            if state.get('last_modified'):
+                headers['If-Modified-Since'] = state['last_modified']
+            try:
+                response = self.client.urlopen(url, headers=headers)
+            except urllib2.HTTPError as e:
+                if e.code == 404 and 'filename' not in state:
+                    continue
+                self._warn(state, "Failed to poll '%s': %s" % (url, e))
+                # look for both files again next time, the validators
+                # only apply to the previous one
+                for key in ['filename', 'etag', 'last_modified']:
+                    state.pop(key, None)
+                return False
+            except urllib2.URLError as e:
+                self._warn(state, "Failed to poll '%s': %s" % (url, e))
+                return False
+            try:
+                data = response.read()
+            finally:
+                response.close()
+            state.pop('warned', None)
+            if response.code == 304:
+                return False
+            # servers ignoring the conditional request send the same content
+            digest = hashlib.sha1(data).hexdigest()
+            changed = digest != state.get('digest')
+            state.update({
+                'filename': filename,
+                'etag': response.headers.getheader('etag'),
+                'last_modified': response.headers.getheader('last-modified'),
+                'digest': digest,
+            })
+            if changed:
+                logging.debug("Release file '%s' has changed" % url)
+            return changed
+        self._warn(state, "Neither 'InRelease' nor 'Release' found for '%s' in '%s'" % (distro, repo_url))
+        return False
+
+    def _warn(self, state, message):
+        # only warn once until the target can be polled again
+        if state.get('warned'):
+            logging.debug(message)
+            return
+        logging.warn(message)
+        state['warned'] = True
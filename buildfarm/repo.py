@@ -36,13 +36,12 @@
 Utilities for reading state from a debian repo
 """
 
-import urllib
 import urllib2
 import re
-import os
-import tempfile
-import shutil
-import gzip
+import zlib
+
+from . import http_client
+from .packages_file import PackagesFile
 
 #from .core import debianize_name
 
@@ -53,29 +52,27 @@ class BadRepo(Exception):
 _Packages_cache = {}
 
 
-def get_Packages(repo_url, os_platform, arch, cache=None):
+def get_Packages(repo_url, os_platform, arch, cache=None, cache_dir=None):
     """
     Retrieve the package list from the shadow repo. This routine
     utilizes a cache and should not be invoked in long-running
     processes.
+    @param cache_dir: directory to store the package list in, a previously
+      stored list is updated incrementally if the repo provides diffs
     @raise BadRepo: if repo does not exist
     """
     if cache is None:
         cache = _Packages_cache
 
-    # this is very bad.  This script is assuming the layout of the
-    # repo has a subdirectory ubuntu.  I can't parameterize it out
-    # without potentially breaking a lot. Using an if statement to get
-    # it to work.
-    if 'packages.ros.org/ros' in repo_url or 'shadow' in repo_url:
-        packages_url = repo_url + '/ubuntu/dists/%(os_platform)s/main/binary-%(arch)s/Packages' % locals()
-    else:
-        packages_url = repo_url + '/dists/%(os_platform)s/main/binary-%(arch)s/Packages' % locals()
+    packages_url = _get_Packages_url(repo_url, os_platform, arch)
     if packages_url in cache:
         return cache[packages_url]
     else:
         try:
-            cache[packages_url] = retval = urllib2.urlopen(packages_url).read()
+            if cache_dir:
+                cache[packages_url] = retval = _fetch_cached_Packages(cache_dir, repo_url, os_platform, arch, packages_url)
+            else:
+                cache[packages_url] = retval = http_client.fetch(packages_url)
         except urllib2.HTTPError as ex:
             raise BadRepo("[%s]: %s (HTTPError: %s)" % (repo_url, packages_url, ex))
         except urllib2.URLError as ex:
@@ -85,6 +82,51 @@ def get_Packages(repo_url, os_platform, arch, cache=None):
     return retval
 
 
+def _fetch_cached_Packages(cache_dir, repo_url, os_platform, arch, packages_url):
+    path = _update_cached_Packages(cache_dir, repo_url, os_platform, arch, packages_url)
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def _update_cached_Packages(cache_dir, repo_url, os_platform, arch, packages_url):
+    from .apt_data import fetch_gzip_file
+    repo_dir = re.sub('[^A-Za-z0-9.-]+', '_', repo_url).strip('_')
+    return fetch_gzip_file(cache_dir, repo_dir, '%s_%s' % (os_platform, arch),
+                           packages_url + '.gz', 'Packages', use_pdiff=True)
+
+
+def open_cached_Packages(repo_url, os_platform, arch, cache_dir):
+    """
+    Update the package list stored in cache_dir and open it for looking up
+    single packages without reading the whole list.
+    @return: packages_file.PackagesFile
+    @raise BadRepo: if repo does not exist
+    """
+    packages_url = _get_Packages_url(repo_url, os_platform, arch)
+    try:
+        path = _update_cached_Packages(cache_dir, repo_url, os_platform, arch, packages_url)
+    except urllib2.URLError as ex:
+        raise BadRepo("[%s]: %s (%s)" % (repo_url, packages_url, ex))
+    return PackagesFile(path)
+
+
+def _get_Packages_url(repo_url, os_platform, arch):
+    # this is very bad.  This script is assuming the layout of the
+    # repo has a subdirectory ubuntu.  I can't parameterize it out
+    # without potentially breaking a lot. Using an if statement to get
+    # it to work.
+    if 'packages.ros.org/ros' in repo_url or 'shadow' in repo_url:
+        return repo_url + '/ubuntu/dists/%(os_platform)s/main/binary-%(arch)s/Packages' % locals()
+    return repo_url + '/dists/%(os_platform)s/main/binary-%(arch)s/Packages' % locals()
+
+
+def _get_Sources_url(repo_url, os_platform):
+    # see _get_Packages_url()
+    if 'packages.ros.org/ros' in repo_url or 'shadow' in repo_url:
+        return repo_url + '/ubuntu/dists/%(os_platform)s/main/source/Sources.gz' % locals()
+    return repo_url + '/dists/%(os_platform)s/main/source/Sources.gz' % locals()
+
+
 def get_source_Packages(repo_url, os_platform, cache=None):
     """
     Retrieve the package list from the shadow repo. This routine
@@ -95,30 +137,112 @@ def get_source_Packages(repo_url, os_platform, cache=None):
     if cache is None:
         cache = _Packages_cache
 
-    # this is very bad.  This script is assuming the layout of the
-    # repo has a subdirectory ubuntu.  I can't parameterize it out
-    # without potentially breaking a lot. Using an if statement to get
-    # it to work.
-    if 'packages.ros.org/ros' in repo_url or 'shadow' in repo_url:
-        packages_url = repo_url + '/ubuntu/dists/%(os_platform)s/main/source/Sources.gz' % locals()
-    else:
-        packages_url = repo_url + '/dists/%(os_platform)s/main/source/Sources.gz' % locals()
+    packages_url = _get_Sources_url(repo_url, os_platform)
     if packages_url in cache:
         return cache[packages_url]
     else:
-        d = tempfile.mkdtemp()
         try:
-            tar_f = urllib.urlretrieve(packages_url, os.path.join(d, 'Source.gz'))
-            tar_h = gzip.open(tar_f[0], 'r:gz')
-            cache[packages_url] = retval = tar_h.read()
+            sources_gz = http_client.fetch(packages_url)
+            cache[packages_url] = retval = zlib.decompress(sources_gz, 16 + zlib.MAX_WBITS)
         except urllib2.HTTPError:
             raise BadRepo("[%s]: %s" % (repo_url, packages_url))
-        finally:
-            if os.path.isdir(d):
-                shutil.rmtree(d)
     return retval
 
 
+class PackagesIndex(object):
+    """
+    The versions of the packages of an apt 'Packages' / 'Sources' list,
+    parsed once so that looking up a package does not scan the whole list.
+    """
+
+    def __init__(self, packagelist):
+        # package name -> [version, rosdistro, has depends] of each paragraph
+        self._packages = {}
+        entry = None
+        for line in packagelist.split('\n'):
+            if not line:
+                entry = None
+            elif line.startswith('Package: '):
+                entry = [None, None, False]
+                self._packages.setdefault(line[len('Package: '):], []).append(entry)
+            elif entry is None:
+                continue
+            elif line.startswith('Version: '):
+                entry[0] = line[len('Version: '):]
+            elif line[:len('wg-rosdistro: ')].lower() == 'wg-rosdistro: ':
+                entry[1] = line[len('wg-rosdistro: '):]
+            elif line.startswith('Depends: '):
+                entry[2] = True
+
+    def __contains__(self, debian_name):
+        return debian_name in self._packages
+
+    def count(self, prefix=''):
+        """
+        Return the number of paragraphs of packages whose name starts with
+        prefix.
+        """
+        return sum([len(v) for n, v in self._packages.iteritems() if n.startswith(prefix)])
+
+    def get_versions(self, debian_name):
+        return [e[0] for e in self._packages.get(debian_name, []) if e[0] is not None]
+
+    def get_rosdistro_versions(self, rosdistro):
+        """
+        Return the versions of all packages with the wg-rosdistro field
+        rosdistro, only considering paragraphs which have a Depends field
+        like parse_Packages() does.
+        """
+        return [v for entries in self._packages.itervalues() for v, d, has_depends in entries
+                if d == rosdistro and has_depends and v is not None]
+
+    def has_version(self, debian_name, version, use_regex=True, match_end=True):
+        """
+        @param version: regular expression which has to match the beginning
+          of the version if use_regex is True, otherwise a prefix of the
+          version
+        @param match_end: if the regular expression has to match the whole
+          version
+        """
+        versions = self.get_versions(debian_name)
+        if not use_regex:
+            return any([v.startswith(version) for v in versions])
+        match = _get_version_matcher(version, match_end)
+        return any([match(v) for v in versions])
+
+
+_version_matchers = {}
+
+
+def _get_version_matcher(pattern, match_end=True):
+    key = (pattern, match_end)
+    if key not in _version_matchers:
+        _version_matchers[key] = re.compile(('(?:%s)$' if match_end else '(?:%s)') % pattern).match
+    return _version_matchers[key]
+
+
+def get_packages_index(repo_url, os_platform, arch, cache=None, source=False):
+    """
+    Return the PackagesIndex of the package list. It is built only once
+    and stored in the cache next to the list.
+    @raise BadRepo: if repo does not exist
+    """
+    if cache is None:
+        cache = _Packages_cache
+
+    if source:
+        key = ('index', _get_Sources_url(repo_url, os_platform))
+    else:
+        key = ('index', _get_Packages_url(repo_url, os_platform, arch))
+    if key not in cache:
+        if source:
+            packagelist = get_source_Packages(repo_url, os_platform, cache)
+        else:
+            packagelist = get_Packages(repo_url, os_platform, arch, cache)
+        cache[key] = PackagesIndex(packagelist)
+    return cache[key]
+
+
 def parse_Packages(packagelist):
     """
     Parse debian Packages list into (package, version, depends) tuples
@@ -155,33 +279,31 @@ def get_repo_version(repo_url, distro, os_platform, arch, source=False):
     """
     Return the greatest build-stamp for any deb in the repository
     """
-    packagelist = load_Packages(repo_url, os_platform, arch, source)
-    return max(['0'] + [x[1][x[1].find('-') + 1:x[1].find('~')] for x in packagelist if x[3] == distro.release_name])
+    index = get_packages_index(repo_url, os_platform, arch, source=source)
+    return max(['0'] + [v[v.find('-') + 1:v.find('~')] for v in index.get_rosdistro_versions(distro.release_name)])
 
 
-def count_packages(repo_url, rosdistro, os_platform, arch, cache=None):
-    packagelist = get_Packages(repo_url, os_platform, arch, cache)
-    M = re.findall('^Package: ros-%s-.*$' % (rosdistro), packagelist, re.MULTILINE)
-    return len(M)
+def count_packages(repo_url, rosdistro, os_platform, arch, cache=None, cache_dir=None):
+    if cache_dir:
+        # only the index of the stored package list is needed
+        with open_cached_Packages(repo_url, os_platform, arch, cache_dir) as packages:
+            return packages.count('ros-%s-' % rosdistro)
+    return get_packages_index(repo_url, os_platform, arch, cache).count('ros-%s-' % rosdistro)
 
 
 def deb_in_repo(repo_url, deb_name, deb_version, os_platform, arch, use_regex=True, cache=None, source=False):
     """
+    @param deb_version: regular expression matching the whole version if
+      use_regex is True, otherwise a prefix of the version. For source
+      packages it is always a regular expression matching the beginning of
+      the version (e.g. the version of the rosdistro followed by the distro
+      without the build stamp).
     @param cache: dictionary to store Packages list for caching
     """
+    index = get_packages_index(repo_url, os_platform, arch, cache, source)
     if source:
-        packagelist = get_source_Packages(repo_url, os_platform, cache)
-        search_string = '^Package: %s\nFormat: .*\nBinary: .*\nArchitecture: .*\nVersion: %s' % (deb_name, deb_version)
-        M = re.search(search_string, packagelist, re.MULTILINE)
-        return M is not None
-    else:
-        packagelist = get_Packages(repo_url, os_platform, arch, cache)
-    if not use_regex:
-        s = 'Package: %s\nVersion: %s' % (deb_name, deb_version)
-        return s in packagelist
-    else:
-        M = re.search('^Package: %s\nVersion: %s$' % (deb_name, deb_version), packagelist, re.MULTILINE)
-        return M is not None
+        return index.has_version(deb_name, deb_version, match_end=False)
+    return index.has_version(deb_name, deb_version, use_regex)
 
 
 def get_depends(repo_url, deb_name, os_platform, arch):
@@ -7,6 +7,7 @@ import sys
 import urllib2
 import yaml
 
+import http_client
 from ros_distro import debianize_package_name, RepoMetadata
 
 URL_PROTOTYPE = "https://raw.github.com/ros/rosdistro/master/releases/%s.yaml"
@@ -19,7 +20,7 @@ class Rosdistro:
         self._targets = None
         # avaliable for backwards compatability
         try:
-            self.repo_map = yaml.load(urllib2.urlopen(URL_PROTOTYPE % rosdistro_name))
+            self.repo_map = yaml.load(http_client.fetch(URL_PROTOTYPE % rosdistro_name))
         except urllib2.HTTPError as ex:
             print("Loading distro from '%s'failed with HTTPError %s" % (URL_PROTOTYPE % rosdistro_name, ex), file=sys.stderr)
             raise
@@ -132,7 +133,7 @@ class Rosdistro:
 
 def get_target_distros(rosdistro):
     print("Fetching " + URL_PROTOTYPE % 'targets')
-    targets_map = yaml.load(urllib2.urlopen(URL_PROTOTYPE % 'targets'))
+    targets_map = yaml.load(http_client.fetch(URL_PROTOTYPE % 'targets'))
     my_targets = [x for x in targets_map if rosdistro in x]
     if len(my_targets) != 1:
         print("Must have exactly one entry for rosdistro %s in targets.yaml" % rosdistro)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+"""
+Summary of a status page and the duration of its generation, written as
+JSON and in the Prometheus text format (e.g. for the textfile collector of
+the node exporter).
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import resource
+import time
+
+from .status_page import CELL_STATES, REPOS
+
+PROMETHEUS_PREFIX = 'buildfarm_status_page'
+
+
+def get_peak_rss():
+    """
+    Return the peak resident set size of this process or any of its
+    terminated child processes in bytes.
+    """
+    # ru_maxrss is in kilobytes on Linux
+    return 1024 * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def get_status_metrics(rosdistro, start_time, versions_table, durations):
+    """
+    Return the metrics of a status page as a dict.
+    @param durations: dict mapping the names of the phases of the
+      generation to their duration in seconds
+    """
+    columns = versions_table.headers[4:]
+    # see get_da_strs()
+    source_columns = [c.endswith('_source') for c in columns]
+    state_counts = versions_table.count_states(source_columns)
+    present_counts = versions_table.count_versions()
+    column_metrics = {}
+    for column, (states, regressions), present in zip(columns, state_counts, present_counts):
+        repos = {}
+        for repo, repo_states, repo_present in zip(REPOS, states, present):
+            repos[repo] = dict(repo_states, present=repo_present)
+        column_metrics[column] = {
+            'repos': repos,
+            'regressions': regressions,
+        }
+    return {
+        'rosdistro': rosdistro,
+        'time': int(time.mktime(start_time)),
+        'packages': len(versions_table.left),
+        'columns': column_metrics,
+        'durations': durations,
+        'peak_rss_bytes': get_peak_rss(),
+    }
+
+
+def _format_labels(labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join(['%s="%s"' % (k, escape(v)) for k, v in labels])
+
+
+def format_prometheus_metrics(metrics):
+    """
+    Return the metrics (see get_status_metrics()) in the Prometheus text
+    format.
+    """
+    rosdistro = [('rosdistro', metrics['rosdistro'])]
+    lines = []
+
+    def add(name, help_text, samples):
+        name = '%s_%s' % (PROMETHEUS_PREFIX, name)
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s gauge' % name)
+        for labels, value in samples:
+            lines.append('%s{%s} %s' % (name, _format_labels(rosdistro + labels), value))
+
+    columns = sorted(metrics['columns'].items())
+    states = ['present'] + sorted(CELL_STATES.values())
+    add('cells', 'Number of packages per column, repo and state.',
+        [([('column', column), ('repo', repo), ('state', state)], data['repos'][repo][state])
+         for column, data in columns for repo in REPOS for state in states])
+    add('regressions', 'Number of packages per column which would regress when syncing to the public repo.',
+        [([('column', column)], data['regressions']) for column, data in columns])
+    add('packages', 'Number of packages on the status page.',
+        [([], metrics['packages'])])
+    add('phase_duration_seconds', 'Duration of the phases of the generation.',
+        [([('phase', phase)], '%.3f' % duration) for phase, duration in sorted(metrics['durations'].items())])
+    add('peak_rss_bytes', 'Peak resident set size of the generation.',
+        [([], metrics['peak_rss_bytes'])])
+    add('timestamp_seconds', 'Start time of the generation.',
+        [([], metrics['time'])])
+    return '\n'.join(lines) + '\n'
+
+
+def write_status_metrics(basename, metrics):
+    """
+    Write the metrics as <basename>.json and <basename>.prom, each
+    replacing the previous file atomically.
+    @return: the paths of the written files
+    """
+    paths = []
+    for ext, content in [('.json', json.dumps(metrics, indent=2, sort_keys=True)),
+                         ('.prom', format_prometheus_metrics(metrics))]:
+        path = basename + ext
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.rename(tmp_path, path)
+        paths.append(path)
+    return paths
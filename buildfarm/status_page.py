@@ -2,33 +2,77 @@
 
 from __future__ import print_function
 
+import cPickle
+import cgi
+import collections
 import csv
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing
 import os
 import re
 from StringIO import StringIO
+import time
 
 # Monkey-patching over some unicode bugs in empy.
 import em
 em.str = unicode
 em.Stream.write_old = em.Stream.write
-em.Stream.write = lambda self, data: em.Stream.write_old(self, data.encode('utf8'))
+
+
+def _write_encoded(self, data):
+    # a ChunkedWriter encodes the buffered output at once
+    if not getattr(self.file, 'accepts_unicode', False):
+        data = data.encode('utf8')
+    em.Stream.write_old(self, data)
+em.Stream.write = _write_encoded
 
 import numpy as np
 
+from buildfarm.debian_version import compare_versions
+from buildfarm.precompress import replace_file
 from buildfarm.ros_distro import debianize_package_name
+from buildfarm.version_history import VersionHistory
 
 version_rx = re.compile(r'[0-9.-]+[0-9]')
 REPOS = ['building', 'shadow-fixed', 'ros/public']
+# increment when the rendering of the rows changes to invalidate cached rows
+ROW_CACHE_FORMAT_VERSION = 2
+# states of a row the page can filter for, bit i of the flags of a row is
+# set if ROW_FLAGS[i] applies (see get_row_flags())
+ROW_FLAGS = ['diff', 'sync', 'regression', 'blue', 'red', 'yellow', 'gray',
+             'red1', 'red2', 'red3']
+# names of the states of the versions in a cell by their color
+CELL_STATES = {
+    None: 'latest',
+    'o': 'outdated',
+    'm': 'missing',
+    'obs': 'obsolete',
+    'i': 'ignored',
+}
+_tag_rx = re.compile(r'<[^>]*>')
+_class_rx = re.compile(r' class="([^"]*)"')
+WRITE_CHUNK_SIZE = 64 * 1024
+# number of rows formatted at once by a worker process
+FORMAT_CHUNK_SIZE = 64
+# number of hex digits of the resource hashes used in urls
+RESOURCE_HASH_LENGTH = 12
 
 
 def get_resource_hashes():
+    """
+    Return the content hashes of the css and js resources which are appended
+    to their urls to invalidate cached resources only when they change.
+    """
     hashes = {}
     for ext in ['css', 'js']:
         path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'resources', ext)
         for filename in os.listdir(path):
             if filename.endswith('.%s' % ext):
-                with open(os.path.join(path, filename)) as f:
-                    hashes[filename] = hash(tuple(f.read()))
+                with open(os.path.join(path, filename), 'rb') as f:
+                    hashes[filename] = hashlib.sha1(f.read()).hexdigest()[:RESOURCE_HASH_LENGTH]
     return hashes
 
 
@@ -53,97 +97,132 @@ def get_distro_arches(arches, rosdistro):
     return [(d, a) for d in distros for a in arches]
 
 
+def get_debian_name_prefixes(rosdistros):
+    """
+    Return the prefixes of the debian package names shown on the status pages
+    of the rosdistros or None if packages without a prefix are shown.
+    """
+    if 'backports' in rosdistros:
+        return None
+    return ['ros-%s-' % rosdistro for rosdistro in rosdistros]
+
+
 def make_versions_table(rd_data, apt_data,
                         da_strs, repo_names, rosdistro):
     '''
     Returns an in-memory table with all the information that will be displayed:
     ros package names and versions followed by debian versions for each
     distro/arch.
+    The distro/arch columns contain integer codes of the cells, the second
+    return value is the list of cells (tuples of the versions in each repo)
+    indexed by their code.
     '''
     left_columns = [('name', object), ('repo', object), ('version', object), ('wet', object)]
-    right_columns = [(da_str, object) for da_str in da_strs]
+    right_columns = [(da_str, np.int32) for da_str in da_strs]
     columns = left_columns + right_columns
 
-    distro_debian_names = [debianize_package_name(rosdistro, pkg.name) for pkg in rd_data.packages.values()]
+    distro_packages = rd_data.packages.values()
+    distro_debian_names = [debianize_package_name(rosdistro, pkg.name) for pkg in distro_packages]
+    distro_debian_names_set = set(distro_debian_names)
 
     # prefixes of other ros distros
     prefixes = ['ros-electric-', 'ros-fuerte-', 'ros-unstable-']
     for distribution in rd_data.rosdistro_index.distributions:
         prefixes.append('ros-%s-' % distribution)
     rosdistro_prefix = 'ros-%s-' % rosdistro
-    if rosdistro_prefix in prefixes:
-        prefixes.remove(rosdistro_prefix)
-
-    non_distro_debian_names = []
-    for debian_name in apt_data.debian_packages:
-        skip = False
-        # skip packages from other ros distros
-        for prefix in prefixes:
-            if debian_name.startswith(prefix):
-                skip = True
-        if skip:
-            continue
-        # skip packages which are in the rosdistro
-        if debian_name in distro_debian_names:
-            continue
-        # skip packages without prefix of this ros distro
-        if not debian_name.startswith(rosdistro_prefix):
-            continue
-        non_distro_debian_names.append(debian_name)
-
-    table = np.empty(len(rd_data.packages) + len(non_distro_debian_names),
+    prefixes = tuple([p for p in prefixes if p != rosdistro_prefix])
+
+    # skip packages from other ros distros, packages which are in the
+    # rosdistro and packages without prefix of this ros distro
+    non_distro_debian_names = [
+        debian_name for debian_name in apt_data.debian_packages
+        if debian_name.startswith(rosdistro_prefix) and
+        not debian_name.startswith(prefixes) and
+        debian_name not in distro_debian_names_set]
+
+    table = np.empty(len(distro_packages) + len(non_distro_debian_names),
                      dtype=columns)
 
-    # add all packages coming from the distro (wet, dry, variant)
-    for i, pkg_data in enumerate(rd_data.packages.values()):
-        table['name'][i] = pkg_data.name
-        repo_name = ''
-        try:
-            repo_name = rd_data.rosdistro_dist.release_packages[pkg_data.name].repository_name
-        except KeyError:
-            pass
-        table['repo'][i] = repo_name
-        table['version'][i] = pkg_data.version
-        table['wet'][i] = pkg_data.type
-        for da_str in da_strs:
-            debian_name = debianize_package_name(rosdistro, pkg_data.name)
-            versions = get_versions(apt_data, debian_name,
-                                    repo_names, da_str)
-            table[da_str][i] = add_version_cell(versions)
-
-    i = len(rd_data.packages)
-    for debian_name in non_distro_debian_names:
-        #undebianized_pkg_name = undebianize_package_name(rosdistro, pkg_name)
-        pkg_name = debian_name
-        if pkg_name.startswith(rosdistro_prefix):
-            pkg_name = pkg_name[len(rosdistro_prefix):]
-        table['name'][i] = pkg_name
-        table['repo'][i] = ''
-        table['version'][i] = ''
-        table['wet'][i] = 'unknown'
-        all_versions = []
-        for da_str in da_strs:
-            versions = get_versions(apt_data, debian_name,
-                                    repo_names, da_str)
-            table[da_str][i] = add_version_cell(versions)
-            all_versions.extend(versions)
-        # if all version values are the same (or None) lets assume that is the expected version
-        unique_versions = set([v for v in all_versions if v != 'None'])
-        if len(unique_versions) == 1:
-            table['version'][i] = unique_versions.pop()
-        i += 1
-
-    return table
+    release_packages = rd_data.rosdistro_dist.release_packages
+    table['name'] = [pkg_data.name for pkg_data in distro_packages] + \
+        [debian_name[len(rosdistro_prefix):] for debian_name in non_distro_debian_names]
+    table['repo'] = [release_packages[pkg_data.name].repository_name if pkg_data.name in release_packages else ''
+                     for pkg_data in distro_packages] + [''] * len(non_distro_debian_names)
+    table['version'] = [pkg_data.version for pkg_data in distro_packages] + [''] * len(non_distro_debian_names)
+    table['wet'] = [pkg_data.type for pkg_data in distro_packages] + ['unknown'] * len(non_distro_debian_names)
+
+    # rows of the packages in the apt data, the missing ones point to an
+    # additional empty row at the end of each column
+    apt_rows = np.array([apt_data.debian_packages.get(debian_name, -1)
+                         for debian_name in distro_debian_names + non_distro_debian_names],
+                        dtype=np.int64)
+
+    # strip the suffix only once per version string
+    stripped_versions = []
+    stripped_ids = {}
+    version_to_stripped = []
+    for version in apt_data.get_version_strings():
+        stripped = strip_version_suffix(str(version))
+        if stripped not in stripped_ids:
+            stripped_ids[stripped] = len(stripped_versions)
+            stripped_versions.append(stripped)
+        version_to_stripped.append(stripped_ids[stripped])
+    version_to_stripped = np.array(version_to_stripped, dtype=np.int64)
+
+    # combine the stripped versions of all repos into one key per cell
+    base = len(stripped_versions)
+    assert base ** len(repo_names) < 2 ** 63
+    cells = []
+    cell_codes = {}
+    stripped_columns = []
+    for da_str in da_strs:
+        keys = np.zeros(len(table), dtype=np.int64)
+        for repo_name in repo_names:
+            version_ids = np.append(_column_to_ndarray(apt_data.get_column(repo_name, da_str)), 0)[apt_rows]
+            stripped = version_to_stripped[version_ids]
+            stripped_columns.append(stripped)
+            keys = keys * base + stripped
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        codes = np.empty(len(unique_keys), dtype=np.int32)
+        for i, key in enumerate(unique_keys.tolist()):
+            if key not in cell_codes:
+                versions = []
+                remainder = key
+                for _ in repo_names:
+                    remainder, stripped_id = divmod(remainder, base)
+                    versions.insert(0, stripped_versions[stripped_id])
+                cell_codes[key] = len(cells)
+                cells.append(tuple(versions))
+            codes[i] = cell_codes[key]
+        table[da_str] = codes[inverse]
+
+    # if all version values of unknown packages are the same (or None) lets
+    # assume that is the expected version
+    if non_distro_debian_names and stripped_columns:
+        none_id = stripped_ids.get('None')
+        unknown_versions = np.column_stack(stripped_columns)[len(distro_packages):]
+        for i, stripped in enumerate(unknown_versions):
+            unique_versions = set(stripped.tolist())
+            unique_versions.discard(none_id)
+            if len(unique_versions) == 1:
+                table['version'][len(distro_packages) + i] = stripped_versions[unique_versions.pop()]
+
+    return table, cells
+
+
+def _column_to_ndarray(column):
+    if not len(column):
+        return np.zeros(0, dtype=np.uint32)
+    return np.frombuffer(column, dtype=np.dtype('u%d' % column.itemsize))
 
 
 def get_versions(apt_data, pkg_name, repo_names, da_str):
-    versions = []
-    for repo_name in repo_names:
-        v = apt_data.get_version(pkg_name, repo_name, da_str)
-        v = str(v)
-        v = strip_version_suffix(v)
-        versions.append(v)
-    return versions
+    versions = apt_data.get_row(pkg_name, [(repo_name, da_str) for repo_name in repo_names])
+    return strip_versions(versions)
+
+
+def strip_versions(versions):
+    return [strip_version_suffix(str(v)) for v in versions]
 
 
 def add_version_cell(versions):
@@ -187,8 +266,140 @@ def get_dist_arch_str(d, a):
     return "%s_%s" % (d, a)
 
 
-def render_csv(rd_data, apt_data, outfile, rosdistro,
-               distro_arches, ros_repos):
+class VersionsTable(object):
+    """
+    The rows of the status page before being formatted: the name, repo,
+    version and type of each package followed by a cell per distro/arch
+    column.
+    Each distinct cell is stored only once as a tuple of the versions in the
+    repos and referenced by its index from the rows.
+    """
+
+    def __init__(self, headers, left, codes, cells):
+        self.headers = list(headers)
+        # the first four values of each row
+        self.left = left
+        # numpy array of cell indices with a row per package and a column
+        # per distro/arch
+        self.codes = codes
+        self.cells = cells
+
+    @classmethod
+    def from_table(cls, table, cells):
+        """
+        Create from the result of make_versions_table().
+        """
+        names = table.dtype.names
+        left = zip(*[['' if v is None else v for v in table[name]] for name in names[:4]])
+        codes = np.zeros((len(table), len(names) - 4), dtype=np.int32)
+        for j, name in enumerate(names[4:]):
+            codes[:, j] = table[name]
+        return VersionsTable(names, [list(l) for l in left], codes, cells)
+
+    @classmethod
+    def from_csv(cls, data_source):
+        reader = csv.reader(data_source, delimiter=',', quotechar='"')
+        headers = reader.next()
+        left = []
+        codes = []
+        cells = []
+        cell_codes = {}
+        for row in reader:
+            left.append(row[:4])
+            row_codes = []
+            for cell in row[4:]:
+                if cell not in cell_codes:
+                    cell_codes[cell] = len(cells)
+                    cells.append(tuple(get_cell_versions(cell)))
+                row_codes.append(cell_codes[cell])
+            codes.append(row_codes)
+        codes = np.array(codes, dtype=np.int32).reshape((len(left), len(headers) - 4))
+        return VersionsTable(headers, left, codes, cells)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = cPickle.load(f)
+        return VersionsTable(data['headers'], data['left'], data['codes'], data['cells'])
+
+    def save(self, path):
+        data = {
+            'headers': self.headers,
+            'left': self.left,
+            'codes': self.codes,
+            'cells': self.cells,
+        }
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            cPickle.dump(data, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+
+    def write_csv(self, fh):
+        w = csv.writer(fh)
+        w.writerow(self.headers)
+        cells = [add_version_cell(c) for c in self.cells]
+        for left, codes in zip(self.left, self.codes.tolist()):
+            w.writerow(left + [cells[c] for c in codes])
+
+    def get_rows(self):
+        """
+        Return the rows as lists of the first four values followed by the
+        version tuples of the cells.
+        """
+        cells = self.cells
+        return [left + [cells[c] for c in codes]
+                for left, codes in zip(self.left, self.codes.tolist())]
+
+    def count_versions(self, repo_count=len(REPOS)):
+        """
+        Return the number of rows with a version in each repo for each
+        distro/arch column.
+        """
+        counts = []
+        for j in range(self.codes.shape[1]):
+            column_counts = [0] * repo_count
+            code_counts = np.bincount(self.codes[:, j], minlength=len(self.cells))
+            for code in np.flatnonzero(code_counts).tolist():
+                for k, version in enumerate(self.cells[code]):
+                    if version != 'None':
+                        column_counts[k] += int(code_counts[code])
+            counts.append(column_counts)
+        return counts
+
+    def count_states(self, source_columns, repo_count=len(REPOS)):
+        """
+        Return the number of cells in each state (see CELL_STATES) per repo
+        and the number of regressions for each distro/arch column.
+        @param source_columns: a flag for each distro/arch column if it
+          contains source packages
+        @return: list of (list of dicts mapping states to counts for each
+          repo, number of regressions) tuples
+        """
+        # for unknown packages the latest version number is only a guess
+        latest_versions = [l[2] if l[3] != 'unknown' else None for l in self.left]
+        # no source packages are expected for dry packages and variants
+        source_versions = [None if l[3] in ['variant', 'dry'] else v
+                           for l, v in zip(self.left, latest_versions)]
+        counts = []
+        for j in range(self.codes.shape[1]):
+            state_counts = [dict([(state, 0) for state in CELL_STATES.values()])
+                            for _ in range(repo_count)]
+            regressions = 0
+            expected = source_versions if source_columns[j] else latest_versions
+            # only evaluate each distinct combination of cell and version once
+            combinations = collections.Counter(zip(self.codes[:, j].tolist(), expected))
+            for (code, latest), n in combinations.iteritems():
+                versions = self.cells[code]
+                for k, version in enumerate(versions):
+                    state_counts[k][CELL_STATES[get_version_color(version, latest)]] += n
+                if is_regression(versions):
+                    regressions += n
+            counts.append((state_counts, regressions))
+        return counts
+
+
+def get_versions_table(rd_data, apt_data, rosdistro,
+                       distro_arches, ros_repos):
     distros = {}
 
     for (d, a) in distro_arches:
@@ -202,119 +413,556 @@ def render_csv(rd_data, apt_data, outfile, rosdistro,
     da_strs = get_da_strs(das)
 
     # Make an in-memory table showing the latest deb version for each package.
-    t = make_versions_table(rd_data,
-                            apt_data,
-                            da_strs,
-                            ros_repos.keys(),
-                            rosdistro)
+    t, cells = make_versions_table(rd_data,
+                                   apt_data,
+                                   da_strs,
+                                   ros_repos.keys(),
+                                   rosdistro)
+    return VersionsTable.from_table(t, cells)
 
+
+def render_csv(rd_data, apt_data, outfile, rosdistro,
+               distro_arches, ros_repos, history_file=None):
+    """
+    @param history_file: if given the changed cells are appended to this
+      version history (see version_history.VersionHistory)
+    """
+    versions_table = get_versions_table(rd_data, apt_data, rosdistro,
+                                        distro_arches, ros_repos)
     with open(outfile, 'w') as fh:
-        # Output CSV from the in-memory table
-        w = csv.writer(fh)
-        w.writerow(t.dtype.names)
-        for row in t:
-            w.writerow(row)
+        versions_table.write_csv(fh)
+    if history_file:
+        VersionHistory(history_file).append(versions_table, int(time.time()), REPOS)
 
 
 def transform_csv_to_html(data_source, metadata_builder,
-                          rosdistro, start_time, template_file, resource_path, cached_distribution=None):
-    reader = csv.reader(data_source, delimiter=',', quotechar='"')
-    rows = [row for row in reader]
+                          rosdistro, start_time, template_file, resource_path, cached_distribution=None,
+                          jobs=1):
+    return transform_table_to_html(VersionsTable.from_csv(data_source), metadata_builder,
+                                   rosdistro, start_time, template_file, resource_path, cached_distribution,
+                                   jobs=jobs)
+
+
+class ChunkedWriter(object):
+    """
+    File-like output of the template interpreter which buffers the written
+    (unicode) strings and writes them utf-8 encoded to a file in chunks.
+    """
+
+    accepts_unicode = True
+
+    def __init__(self, f, chunk_size=WRITE_CHUNK_SIZE):
+        self._file = f
+        self._chunk_size = chunk_size
+        self._buffer = []
+        self._size = 0
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._size += len(data)
+        if self._size >= self._chunk_size:
+            self.flush()
 
-    headers = rows[0]
-    rows = rows[1:]
+    def flush(self):
+        if self._buffer:
+            self._file.write(u''.join(self._buffer).encode('utf8'))
+            self._buffer = []
+            self._size = 0
+
+    def close(self):
+        # the underlying file is closed by its owner
+        self.flush()
+
+
+def render_template(template_file, f, data):
+    """
+    Expand an empy template and stream the output to the file object f.
+    """
+    writer = ChunkedWriter(f)
+    interpreter = em.Interpreter(output=writer)
+    try:
+        with open(template_file) as template:
+            interpreter.file(template, locals=data)
+        writer.flush()
+    finally:
+        interpreter.shutdown()
+
+
+def transform_table_to_html(versions_table, metadata_builder,
+                            rosdistro, start_time, template_file, resource_path, cached_distribution=None,
+                            row_cache_file=None, delta_file=None, jobs=1):
+    output = StringIO()
+    write_status_page(output, versions_table, metadata_builder,
+                      rosdistro, start_time, template_file, resource_path, cached_distribution,
+                      row_cache_file=row_cache_file, delta_file=delta_file, jobs=jobs)
+    return output.getvalue()
+
+
+def write_status_page(f, versions_table, metadata_builder,
+                      rosdistro, start_time, template_file, resource_path, cached_distribution=None,
+                      row_cache_file=None, delta_file=None, data_file=None, jobs=1,
+                      sharded=False, precompress=False, use_brotli=False):
+    """
+    Render the status page to the file object f.
+    The rows are rendered while the table body is being written.
+    @param data_file: if given the rows are not part of the page but written
+      to this JSON file which is loaded and rendered by the browser (see
+      get_status_page_data())
+    @param sharded: if True the cells of each distro/arch column are written
+      to a separate JSON file next to the data_file (see get_shard_file())
+      which the browser only loads for the selected distros
+    @param row_cache_file: file to store the rendered rows in, only the rows
+      whose inputs have changed since the previous run are rendered again
+    @param delta_file: JSON file listing the names of the packages whose rows
+      have been added, changed or removed since the previous run (requires
+      the row_cache_file)
+    @param jobs: number of processes formatting the rows in parallel, the
+      output is the same as with a single process
+    @param precompress: if True compressed copies of the JSON files are
+      written next to them (see precompress.compress_file())
+    """
+    headers = versions_table.headers
 
     metadata_columns = [None] * 4 + [metadata_builder(c) for c in headers[4:]]
     headers = [format_header_cell(headers[i], metadata_columns[i])
                for i in range(len(headers))]
 
     # count non-None rows per (sub-)column
-    row_counts = [[]] * 4 + [[0] * 3 for _ in range(4, len(headers))]
-    for row in rows:
-        for i in range(4, len(row_counts)):
-            versions = get_cell_versions(row[i])
-            for j in range(0, len(versions)):
-                if versions[j] != 'None':
-                    row_counts[i][j] += 1
-
-    def get_package_name_from_row(row):
-        return row[0]
-    rows = sorted(rows, key=get_package_name_from_row)
-    rows = [format_row(r, metadata_columns) for r in rows]
-    inject_status_and_maintainer(cached_distribution, headers, row_counts, rows)
+    row_counts = [[]] * 4 + versions_table.count_versions()
+
+    # indices of the rows in the versions table ordered by package name
+    order = sorted(range(len(versions_table.left)), key=lambda i: versions_table.left[i][0])
+    rows = versions_table.get_rows()
+    rows = [rows[i] for i in order]
+
+    render = format_row_meta if data_file else render_row
+    cache_key = repr([ROW_CACHE_FORMAT_VERSION, render.__name__, metadata_columns])
+    previous_rows = load_row_cache(row_cache_file) if row_cache_file else {}
+    rendered_rows = {}
+
+    fingerprints = [get_row_fingerprint(row, cached_distribution) for row in rows]
+    cached = []
+    for row, fingerprint in itertools.izip(rows, fingerprints):
+        previous = previous_rows.get(row[0])
+        cached.append(previous and previous[0] == fingerprint and previous[1] == cache_key)
+
+    pending = [row for row, is_cached in itertools.izip(rows, cached) if not is_cached]
+    formatted_rows = iter_formatted_rows(pending, render, metadata_columns, cached_distribution, jobs)
+
+    def iter_rendered_rows(rows):
+        for row, fingerprint, is_cached in itertools.izip(rows, fingerprints, cached):
+            pkg_name = row[0]
+            if is_cached:
+                rendered = previous_rows[pkg_name][2]
+            else:
+                rendered = next(formatted_rows)
+            if row_cache_file:
+                rendered_rows[pkg_name] = (fingerprint, cache_key, rendered)
+            yield rendered
+
+    data_url = None
+    shard_urls = None
+    shard_groups = None
+    if data_file:
+        data = get_status_page_data(rows, iter_rendered_rows(rows), metadata_columns,
+                                    include_cells=not sharded)
+        _write_json_file(data_file, data, precompress, use_brotli)
+        # the timestamp prevents browsers from using a cached old payload
+        data_url = '%s?%d' % (os.path.basename(data_file), int(time.mktime(start_time)))
+        if sharded:
+            shard_urls = []
+            for column, header in enumerate(versions_table.headers[4:]):
+                shard_file = get_shard_file(data_file, header)
+                _write_json_file(shard_file, get_column_data(versions_table, order, column),
+                                 precompress, use_brotli)
+                shard_urls.append('%s?%d' % (os.path.basename(shard_file), int(time.mktime(start_time))))
+            shard_groups = get_shard_groups(versions_table.headers[4:])
+        rows = []
+    else:
+        rows = iter_rendered_rows(rows)
+    headers[4:4] = ['Status', 'Maintainer']
+    row_counts[4:4] = [[], []]
+
+    repos = REPOS
+    row_flags = ROW_FLAGS
+
+    resource_hashes = get_resource_hashes()
+
+    render_template(template_file, f, locals())
+
+    if row_cache_file:
+        save_row_cache(row_cache_file, rendered_rows)
+        if delta_file:
+            write_row_delta(delta_file, rosdistro, start_time, previous_rows, rendered_rows,
+                            precompress, use_brotli)
+
+
+# state inherited by the forked row formatting processes
+_format_context = {}
+
+
+def _format_rows(rows):
+    render = _format_context['render']
+    return [render(row, _format_context['metadata_columns'], _format_context['cached_distribution'])
+            for row in rows]
+
+
+def iter_formatted_rows(rows, render, metadata_columns, cached_distribution, jobs=1):
+    """
+    Format the rows with render(), using a pool of processes if jobs is
+    greater than one. The rows are yielded in order while the processes
+    format the following chunks of rows.
+    """
+    if jobs <= 1 or len(rows) <= FORMAT_CHUNK_SIZE:
+        for row in rows:
+            yield render(row, metadata_columns, cached_distribution)
+        return
+
+    # the forked processes inherit the context instead of receiving the
+    # cached distribution with every chunk
+    _format_context.update({
+        'render': render,
+        'metadata_columns': metadata_columns,
+        'cached_distribution': cached_distribution,
+    })
+    pool = multiprocessing.Pool(jobs)
+    try:
+        chunks = [rows[i:i + FORMAT_CHUNK_SIZE] for i in range(0, len(rows), FORMAT_CHUNK_SIZE)]
+        for formatted_rows in pool.imap(_format_rows, chunks):
+            for formatted_row in formatted_rows:
+                yield formatted_row
+    finally:
+        pool.terminate()
+        pool.join()
+        _format_context.clear()
+
+
+def render_row(row, metadata_columns, cached_distribution):
+    """
+    Return the HTML of a table row.
+    @param row: the first four values of the row followed by the version
+      tuples of the cells
+    """
+    cells = format_cells(row, metadata_columns, cached_distribution)
+    return '<tr data-flags="%d" data-search="%s">%s</tr>' % \
+        (get_row_flags(row, metadata_columns), cgi.escape(get_search_key(cells[:6]), True),
+         ''.join(['<td>%s</td>' % cell for cell in cells]))
+
+
+def format_row_meta(row, metadata_columns, cached_distribution):
+    """
+    Return the HTML of the cells of a table row before the version cells,
+    the flags and the search key of the row.
+    """
+    # the name, repo, version and type followed by the status and maintainer
+    cells = format_cells(row[:4], metadata_columns, cached_distribution)
+    return [cells, get_row_flags(row, metadata_columns), get_search_key(cells)]
+
+
+def get_row_flags(row, metadata_columns):
+    """
+    Return the states of a row as bits of an integer (see ROW_FLAGS).
+    @param row: the first four values of the row followed by the version
+      tuples of the cells
+    """
+    states = set()
+    # Flag if this is dry or a variant so as not to show sourcedebs as red
+    no_source = row[3] in ['variant', 'dry']
+    # ignore source columns for dry/variant when deciding of columns are homogeneous
+    diff_columns = [c for i, c in enumerate(row) if i > 3 and (not no_source or i % 3 - 1)]
+    if len(set(diff_columns)) > 1:
+        states.add('diff')
+
+    # for unknown packages the latest version number is only a guess so don't mark missing cells
+    latest_version = row[2] if row[3] != 'unknown' else None
+    for i in range(4, len(row)):
+        versions = row[i]
+        if is_public_changing_on_sync(versions):
+            states.add('sync')
+        if is_regression(versions):
+            states.add('regression')
+        latest = None if no_source and metadata_columns[i]['is_source'] else latest_version
+        for j, version in enumerate(versions):
+            color = get_version_color(version, latest)
+            if color == 'm':
+                states.add('red')
+                # the position of the missing package within the repos
+                if j == 0:
+                    states.add('red1')
+                if j == len(versions) - 1:
+                    states.add('red3')
+                if 0 < j < len(versions) - 1:
+                    states.add('red2')
+            elif color:
+                states.add({'o': 'blue', 'obs': 'yellow', 'i': 'gray'}[color])
+
+    return sum([1 << i for i, state in enumerate(ROW_FLAGS) if state in states])
+
+
+def get_search_key(cells):
+    """
+    Return the lowercased text of the cells separated by newlines.
+    Cells without text (e.g. the status) are represented by their classes.
+    """
+    texts = []
+    for cell in cells:
+        text = _tag_rx.sub('', cell).strip()
+        texts.append(text if text else ' '.join(_class_rx.findall(cell)))
+    return '\n'.join(texts).lower()
+
+
+def format_cells(row, metadata_columns, cached_distribution):
+    row = format_row(row, metadata_columns)
+    inject_row_status_and_maintainer(cached_distribution, row)
 
     # div-wrap the first three cells for layout reasons. It's difficult to contrain the
     # overall dimensions of a table cell without an inner element to use as the overflow
     # container.
-    for row in rows:
-        for i in range(3):
-            row[i] = "<div>%s</div>" % row[i]
+    for i in range(3):
+        row[i] = "<div>%s</div>" % row[i]
+    return row
 
-    repos = REPOS
 
-    resource_hashes = get_resource_hashes()
+def get_status_page_data(rows, row_metas, metadata_columns, include_cells=True):
+    """
+    Return the rows of the status page for the JSON payload rendered by the
+    browser.
+    The versions and the cells are dictionary-encoded: 'versions' lists the
+    distinct version strings, 'cells' the distinct cells as lists of version
+    indices. Each row consists of the HTML of the meta cells, the flags and
+    the search key of the row, the index of the expected version (or -1), a
+    flag if no source packages are expected and the run-length-encoded cell
+    indices of the distro/arch columns as alternating index and count.
+    @param rows: the first four values of each row followed by the version
+      tuples of the cells
+    @param row_metas: the formatted meta cells, the flags and the search key
+      of each row (see format_row_meta())
+    @param include_cells: if False the rows end after the flag for source
+      packages and 'cells' is omitted, the cells are provided by separate
+      fragments per column instead (see get_column_data())
+    """
+    versions = []
+    version_ids = {}
+    cells = []
+    cell_ids = {}
+
+    def get_version_id(version):
+        if version not in version_ids:
+            version_ids[version] = len(versions)
+            versions.append(version)
+        return version_ids[version]
+
+    data_rows = []
+    for row, (meta, flags, search_key) in itertools.izip(rows, row_metas):
+        # for unknown packages the latest version number is only a guess
+        latest = get_version_id(row[2]) if row[2] and row[3] != 'unknown' else -1
+        no_source = 1 if row[3] in ['variant', 'dry'] else 0
+        data_row = [meta, flags, search_key, latest, no_source]
+        if include_cells:
+            rle = []
+            for cell in row[4:]:
+                if cell not in cell_ids:
+                    cell_ids[cell] = len(cells)
+                    cells.append([get_version_id(v) for v in cell])
+                cell_id = cell_ids[cell]
+                if rle and rle[-2] == cell_id:
+                    rle[-1] += 1
+                else:
+                    rle += [cell_id, 1]
+            data_row.append(rle)
+        data_rows.append(data_row)
+
+    data = {
+        'versions': versions,
+        'source_columns': [1 if md['is_source'] else 0 for md in metadata_columns[4:]],
+        'rows': data_rows,
+    }
+    if include_cells:
+        data['cells'] = cells
+    return data
 
-    output = StringIO()
+
+def get_column_data(versions_table, order, column):
+    """
+    Return the cells of a single distro/arch column for a JSON fragment.
+    The versions and cells are dictionary-encoded like in
+    get_status_page_data() and 'rows' contains the run-length-encoded cell
+    indices of the rows as alternating index and count.
+    @param order: the indices of the rows of the versions table in the order
+      of the rows of the payload
+    """
+    versions = []
+    version_ids = {}
+    cells = []
+    cell_ids = {}
+    rle = []
+    for code in versions_table.codes[order, column].tolist():
+        if code not in cell_ids:
+            cell_ids[code] = len(cells)
+            cell = []
+            for version in versions_table.cells[code]:
+                if version not in version_ids:
+                    version_ids[version] = len(versions)
+                    versions.append(version)
+                cell.append(version_ids[version])
+            cells.append(cell)
+        cell_id = cell_ids[code]
+        if rle and rle[-2] == cell_id:
+            rle[-1] += 1
+        else:
+            rle += [cell_id, 1]
+    return {
+        'versions': versions,
+        'cells': cells,
+        'rows': rle,
+    }
+
+
+def get_shard_file(data_file, column):
+    """
+    Return the path of the JSON fragment of a distro/arch column (e.g.
+    'precise_amd64') of the page whose rows are stored in data_file.
+    """
+    return '%s.%s.json' % (os.path.splitext(data_file)[0], column)
+
+
+def get_shard_groups(columns):
+    """
+    Group the distro/arch columns by distro.
+    @return: list of (distro, list of column indices) tuples
+    """
+    groups = []
+    for i, column in enumerate(columns):
+        distro = column.split('_')[0]
+        if not groups or groups[-1][0] != distro:
+            groups.append((distro, []))
+        groups[-1][1].append(i)
+    return groups
+
+
+def _write_json_file(path, data, compress=False, use_brotli=False):
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, separators=(',', ':'))
+    replace_file(tmp_path, path, compress, use_brotli)
+
+
+def get_row_fingerprint(row, cached_distribution):
+    """
+    Return a hash of all inputs of the rendered row.
+    """
+    inputs = [row]
+    if row[3] == 'wet' and cached_distribution:
+        pkg_name = row[0]
+        pkg = cached_distribution.release_packages[pkg_name]
+        repo = cached_distribution.repositories[pkg.repository_name]
+        inputs += [pkg.status, pkg.status_description, repo.status, repo.status_description,
+                   cached_distribution.get_release_package_xml(pkg_name)]
+        for source in [repo.source_repository, repo.doc_repository]:
+            inputs += [source.url, source.version] if source else [None, None]
+    return hashlib.sha1(repr(inputs)).hexdigest()
+
+
+def load_row_cache(path):
+    """
+    Load the rendered rows of a previous run.
+    @return: dict mapping the package names to a tuple of the fingerprint of
+      the inputs, the cache key and the HTML of the row
+    """
+    if not os.path.exists(path):
+        return {}
     try:
-        interpreter = em.Interpreter(output=output)
-        interpreter.file(open(template_file), locals=locals())
-        return output.getvalue()
-    finally:
-        interpreter.shutdown()
+        with open(path, 'rb') as f:
+            return cPickle.load(f)
+    except Exception as e:
+        logging.warn("Ignoring invalid row cache '%s': %s" % (path, e))
+        return {}
+
+
+def save_row_cache(path, rows):
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        cPickle.dump(rows, f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_path, path)
+
+
+def write_row_delta(path, rosdistro, start_time, previous_rows, rows, compress=False, use_brotli=False):
+    """
+    Write the names of the packages whose rows have been added, changed or
+    removed as JSON.
+    @param compress: if True compressed copies are written next to the file
+    """
+    delta = {
+        'rosdistro': rosdistro,
+        'time': int(time.mktime(start_time)),
+        'added': sorted([n for n in rows if n not in previous_rows]),
+        'changed': sorted([n for n in rows if n in previous_rows and rows[n][0] != previous_rows[n][0]]),
+        'removed': sorted([n for n in previous_rows if n not in rows]),
+    }
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(delta, f, indent=2)
+    replace_file(tmp_path, path, compress, use_brotli)
+    logging.debug('Rows added: %d, changed: %d, removed: %d' %
+                  (len(delta['added']), len(delta['changed']), len(delta['removed'])))
 
 
 def inject_status_and_maintainer(cached_distribution, header, counts, rows):
-    from catkin_pkg.package import InvalidPackage, parse_package_string
     header[4:4] = ['Status', 'Maintainer']
     counts[4:4] = [[], []]
     for row in rows:
-        status_cell = ''
-        maintainer_cell = '<a>?</a>'
-        # Use website url if defined, otherwise default to ros wiki
-        pkg_name = row[0].split(' ')[0]
-        url = 'http://wiki.ros.org/%s' % pkg_name
-        repo_name = row[1]
-        repo_url = None
-        repo_version = None
-        if row[3] == 'wet' and cached_distribution:
-            pkg = cached_distribution.release_packages[pkg_name]
-            repo = cached_distribution.repositories[pkg.repository_name]
-            status = 'unknown'
-            if pkg.status is not None:
-                status = pkg.status
-            elif repo.status is not None:
-                status = repo.status
-            status_description = ''
-            if pkg.status_description is not None:
-                status_description = pkg.status_description
-            elif repo.status_description is not None:
-                status_description = repo.status_description
-            status_cell = '<a class="%s"%s/>' % (status, ' title="%s"' % status_description if status_description else '')
-            pkg_xml = cached_distribution.get_release_package_xml(pkg_name)
-            if pkg_xml is not None:
-                try:
-                    pkg = parse_package_string(pkg_xml)
-                    maintainer_cell = ''.join(['<a href="mailto:%s">%s</a>' % (m.email, m.name) for m in pkg.maintainers])
-                    for u in pkg['urls']:
-                        if u.type == 'website':
-                            url = u
-                            break
-                except InvalidPackage:
-                    maintainer_cell = '<a><b>bad package.xml</b></a>'
-            if repo.source_repository:
-                repo_url = repo.source_repository.url
-                repo_version = repo.source_repository.version
-            elif repo.doc_repository:
-                repo_url = repo.doc_repository.url
-                repo_version = repo.doc_repository.version
-        else:
-            status_cell = '<a class="unknown"/>'
-        row[0] = row[0].replace(pkg_name, '<a href="%s">%s</a>' % (url, pkg_name), 1)
-        if repo_url:
-            if repo_url.startswith('https://github.com/') and repo_url.endswith('.git') and repo_version:
-                repo_url = '%s/tree/%s' % (repo_url[:-4], repo_version)
-            row[1] = '<a href="%s">%s</a>' % (repo_url, repo_name)
-        row[4:4] = [status_cell, maintainer_cell]
+        inject_row_status_and_maintainer(cached_distribution, row)
+
+
+def inject_row_status_and_maintainer(cached_distribution, row):
+    from catkin_pkg.package import InvalidPackage, parse_package_string
+    status_cell = ''
+    maintainer_cell = '<a>?</a>'
+    # Use website url if defined, otherwise default to ros wiki
+    pkg_name = row[0].split(' ')[0]
+    url = 'http://wiki.ros.org/%s' % pkg_name
+    repo_name = row[1]
+    repo_url = None
+    repo_version = None
+    if row[3] == 'wet' and cached_distribution:
+        pkg = cached_distribution.release_packages[pkg_name]
+        repo = cached_distribution.repositories[pkg.repository_name]
+        status = 'unknown'
+        if pkg.status is not None:
+            status = pkg.status
+        elif repo.status is not None:
+            status = repo.status
+        status_description = ''
+        if pkg.status_description is not None:
+            status_description = pkg.status_description
+        elif repo.status_description is not None:
+            status_description = repo.status_description
+        status_cell = '<a class="%s"%s/>' % (status, ' title="%s"' % status_description if status_description else '')
+        pkg_xml = cached_distribution.get_release_package_xml(pkg_name)
+        if pkg_xml is not None:
+            try:
+                pkg = parse_package_string(pkg_xml)
+                maintainer_cell = ''.join(['<a href="mailto:%s">%s</a>' % (m.email, m.name) for m in pkg.maintainers])
+                for u in pkg['urls']:
+                    if u.type == 'website':
+                        url = u
+                        break
+            except InvalidPackage:
+                maintainer_cell = '<a><b>bad package.xml</b></a>'
+        if repo.source_repository:
+            repo_url = repo.source_repository.url
+            repo_version = repo.source_repository.version
+        elif repo.doc_repository:
+            repo_url = repo.doc_repository.url
+            repo_version = repo.doc_repository.version
+    else:
+        status_cell = '<a class="unknown"/>'
+    row[0] = row[0].replace(pkg_name, '<a href="%s">%s</a>' % (url, pkg_name), 1)
+    if repo_url:
+        if repo_url.startswith('https://github.com/') and repo_url.endswith('.git') and repo_version:
+            repo_url = '%s/tree/%s' % (repo_url[:-4], repo_version)
+        row[1] = '<a href="%s">%s</a>' % (repo_url, repo_name)
+    row[4:4] = [status_cell, maintainer_cell]
 
 
 def format_header_cell(cell, metadata):
@@ -326,36 +974,23 @@ def format_header_cell(cell, metadata):
 
 
 def format_row(row, metadata_columns):
-    public_changing_on_sync = [False] * 4 + \
-        [is_public_changing_on_sync(c) for c in row[4:]]
-    regression = [False] * 4 + \
-        [is_regression(c) for c in row[4:]]
+    """
+    @param row: the first four values of the row followed by the version
+      tuples of the cells
+    """
     # Flag if this is dry or a variant so as not to show sourcedebs as red
     no_source = row[3] in ['variant', 'dry']
-    # ignore source columns for dry/variant when deciding of columns are homogeneous
-    diff_columns = [c for i, c in enumerate(row) if i > 3 and (not no_source or i % 3 - 1)]
-    has_diff_between_rosdistros = len(set(diff_columns)) > 1
 
     # urls for each building repository column
     metadata = [None] * 4 + [md for md in metadata_columns[4:]]
     # for unknown packages the latest version number is only a guess so don't mark missing cells
     latest_version = row[2] if row[3] != 'unknown' else None
     # only pass no_source if this is a sourcedeb entry
-    row = row[:4] + [format_versions_cell(get_cell_versions(row[i]),
+    row = row[:4] + [format_versions_cell(row[i],
                                           latest_version,
                                           no_source and metadata[i]['is_source'])
                      for i in range(4, len(row))]
 
-    hidden_texts = []
-    if has_diff_between_rosdistros:
-        hidden_texts.append('diff')
-    if True in public_changing_on_sync:
-        hidden_texts.append('sync')
-    if True in regression:
-        hidden_texts.append('regression')
-    if len(hidden_texts) > 0:
-        row[0] += ' <span class="ht">%s</span>' % ' '.join(hidden_texts)
-
     type_texts = {
         'wet': 'wet',
         'dry': 'dry',
@@ -366,22 +1001,18 @@ def format_row(row, metadata_columns):
     return row
 
 
-def is_public_changing_on_sync(cell):
-    versions = get_cell_versions(cell)
+def is_public_changing_on_sync(versions):
     return versions[1] != versions[2]
 
 
-def is_regression(cell):
-    versions = get_cell_versions(cell)
+def is_regression(versions):
     public_version = versions[-1]
     if public_version != "None":
-        public_version_parts = [int(y) for x in public_version.split('.') for y in x.split('-')]
         for v in versions:
             if v == "None":
                 return True
             # a downgrade of the version is considered to be a regression
-            v_parts = [int(y) for x in v.split('.') for y in x.split('-')]
-            if public_version_parts > v_parts:
+            if compare_versions(public_version, v) > 0:
                 return True
     return False
 
@@ -401,6 +1032,20 @@ def format_versions_cell(versions, latest_version,
 
 
 def format_version(version, latest):
+    color = get_version_color(version, latest)
+    label = version
+    if version == latest:
+        # When version is the same as latest, Javascript will infer it. This
+        # avoids repetition in the HTML page.
+        label = None
+    if color in ['m', 'i']:
+        # These color blocks represent no-package, which Javascript knows too;
+        # no need to explicitly specify.
+        label = None
+    return make_square_div(label, color)
+
+
+def get_version_color(version, latest):
     if latest:
         if not version or version == 'None':
             color = 'm'  # missing
@@ -413,17 +1058,7 @@ def format_version(version, latest):
             color = 'i'  # ignore
         else:
             color = 'obs'  # obsolete
-
-    label = version
-    if version == latest:
-        # When version is the same as latest, Javascript will infer it. This
-        # avoids repetition in the HTML page.
-        label = None
-    if color in ['m', 'i']:
-        # These color blocks represent no-package, which Javascript knows too;
-        # no need to explicitly specify.
-        label = None
-    return make_square_div(label, color)
+    return color
 
 
 def make_square_div(label, color):
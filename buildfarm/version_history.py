@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+
+"""
+Append-only history of the versions tables of a rosdistro.
+
+Every run appends only the cells which have changed since the previous run
+to a log file. Versions and column names are dictionary-encoded within the
+log. A sidecar index stores the offsets of the records of each package and
+the latest cells, so appending a run only needs the index and the timeline
+of a package is read without scanning the log. The index can always be
+rebuilt from the log.
+
+Loading a history never modifies any file, so it can be queried while a run
+is appending to it. Writers hold an exclusive lock on the log and repair an
+incomplete record left by an interrupted run before appending.
+"""
+
+from __future__ import print_function
+
+import bisect
+import cPickle
+import fcntl
+import logging
+import os
+import struct
+
+INDEX_SUFFIX = '.index'
+INDEX_FORMAT_VERSION = 2
+# pseudo column of the version of the package in the rosdistro
+VERSION_COLUMN = 'version'
+
+# each record of the log is prefixed with the length of its pickle
+_length = struct.Struct('<I')
+
+
+class VersionHistory(object):
+    """
+    The log consists of these records:
+    - ('run', timestamp)
+    - ('repos', repo names), whenever the repos of the cells change,
+      followed by the records of all cells
+    - ('versions', new versions), extending the version dictionary
+    - ('columns', new column names), extending the column dictionary
+    - ('package', run index, name, changes) with changes being a list of
+      (column index, cell) tuples where a cell is a tuple of version indices
+      (one per repo) or None if the column has been removed, changes is
+      None if the package has been removed
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.runs = []
+        self.repos = []
+        # the first run using each list of repo names
+        self._repo_runs = []
+        self._repo_names = []
+        self.versions = []
+        self.columns = []
+        # offsets of the records of each package
+        self.packages = {}
+        self._version_ids = {}
+        self._column_ids = {}
+        # the latest cells of each package by column index
+        self._state = {}
+        # size of the log covered by the index
+        self._size = 0
+        self._load()
+
+    def append(self, versions_table, timestamp, repos):
+        """
+        Append the cells of the versions table which have changed since the
+        previous run.
+        @param timestamp: seconds since the epoch
+        @param repos: the names of the repos in the order of the versions of
+          each cell
+        @return: the number of added, changed or removed packages
+        """
+        with open(self.path, 'ab') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                # the records are encoded relative to the ones of other
+                # writers which have been appended since loading
+                offset = self._repair(f)
+                records = self._get_records(versions_table, timestamp, repos)
+                for record in records:
+                    data = cPickle.dumps(record, cPickle.HIGHEST_PROTOCOL)
+                    f.write(_length.pack(len(data)))
+                    f.write(data)
+                    self._apply(offset, record)
+                    offset += _length.size + len(data)
+                f.flush()
+                os.fsync(f.fileno())
+                self._size = offset
+                self._save_index()
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        count = len([r for r in records if r[0] == 'package'])
+        logging.debug("Appended %d changed packages to '%s'" % (count, self.path))
+        return count
+
+    def _get_records(self, versions_table, timestamp, repos):
+        new_versions = []
+        new_version_ids = {}
+        new_columns = []
+
+        def get_version_id(version):
+            version_id = self._version_ids.get(version)
+            if version_id is None:
+                version_id = new_version_ids.get(version)
+                if version_id is None:
+                    version_id = len(self.versions) + len(new_versions)
+                    new_version_ids[version] = version_id
+                    new_versions.append(version)
+            return version_id
+
+        def get_column_id(column):
+            column_id = self._column_ids.get(column)
+            if column_id is None:
+                if column not in new_columns:
+                    new_columns.append(column)
+                column_id = len(self.columns) + new_columns.index(column)
+            return column_id
+
+        run = len(self.runs)
+        # the cells of all packages are recorded again with the new repo
+        # names, so that each cell is labeled by the repos of its own run
+        repos_changed = list(repos) != self.repos
+        version_column = get_column_id(VERSION_COLUMN)
+        column_ids = [get_column_id(c) for c in versions_table.headers[4:]]
+        current_columns = set([version_column] + column_ids)
+        # encode each distinct cell only once
+        cells = [tuple([get_version_id(v) for v in cell]) for cell in versions_table.cells]
+
+        package_records = []
+        names = set()
+        for left, codes in zip(versions_table.left, versions_table.codes.tolist()):
+            name = left[0]
+            names.add(name)
+            state = self._state.get(name, {})
+            changes = []
+            cell = (get_version_id(left[2]),)
+            if state.get(version_column) != cell:
+                changes.append((version_column, cell))
+            for column_id, code in zip(column_ids, codes):
+                if repos_changed or state.get(column_id) != cells[code]:
+                    changes.append((column_id, cells[code]))
+            for column_id in sorted(set(state.keys()) - current_columns):
+                changes.append((column_id, None))
+            if changes:
+                package_records.append(('package', run, name, changes))
+        for name in sorted(set(self._state.keys()) - names):
+            package_records.append(('package', run, name, None))
+
+        records = [('run', timestamp)]
+        if repos_changed:
+            records.append(('repos', list(repos)))
+        if new_versions:
+            records.append(('versions', new_versions))
+        if new_columns:
+            records.append(('columns', new_columns))
+        records += package_records
+        return records
+
+    def get_repos(self, run):
+        """
+        Return the names of the repos of the versions of the cells of a run.
+        """
+        i = bisect.bisect_right(self._repo_runs, run) - 1
+        return self._repo_names[i] if i >= 0 else []
+
+    def get_timeline(self, name):
+        """
+        Return the changes of a package in the order of the runs.
+        @return: list of (timestamp, column, versions, repos) tuples with
+          versions being a tuple of the version in each of the repos (see
+          get_repos()) or None if the column has been removed, column and
+          versions are None if the package has been removed
+        """
+        timeline = []
+        offsets = self.packages.get(name, [])
+        if not offsets:
+            return timeline
+        with open(self.path, 'rb') as f:
+            for offset in offsets:
+                _, run, _, changes = self._read_record(f, offset)
+                timestamp = self.runs[run]
+                repos = self.get_repos(run)
+                if changes is None:
+                    timeline.append((timestamp, None, None, repos))
+                    continue
+                for column_id, cell in changes:
+                    versions = None
+                    if cell is not None:
+                        versions = tuple([self.versions[v] for v in cell])
+                    timeline.append((timestamp, self.columns[column_id], versions, repos))
+        return timeline
+
+    def _apply(self, offset, record):
+        kind = record[0]
+        if kind == 'run':
+            self.runs.append(record[1])
+        elif kind == 'repos':
+            # follows the record of the run it applies to
+            self.repos = record[1]
+            self._repo_runs.append(len(self.runs) - 1)
+            self._repo_names.append(record[1])
+        elif kind == 'versions':
+            for version in record[1]:
+                self._version_ids[version] = len(self.versions)
+                self.versions.append(version)
+        elif kind == 'columns':
+            for column in record[1]:
+                self._column_ids[column] = len(self.columns)
+                self.columns.append(column)
+        elif kind == 'package':
+            _, _, name, changes = record
+            self.packages.setdefault(name, []).append(offset)
+            if changes is None:
+                self._state.pop(name, None)
+                return
+            state = self._state.setdefault(name, {})
+            for column_id, cell in changes:
+                if cell is None:
+                    state.pop(column_id, None)
+                else:
+                    state[column_id] = cell
+
+    def _read_record(self, f, offset):
+        f.seek(offset)
+        header = f.read(_length.size)
+        if len(header) < _length.size:
+            return None
+        data = f.read(_length.unpack(header)[0])
+        if len(data) < _length.unpack(header)[0]:
+            return None
+        return cPickle.loads(data)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        index_path = self.path + INDEX_SUFFIX
+        if os.path.exists(index_path):
+            try:
+                with open(index_path, 'rb') as f:
+                    index = cPickle.load(f)
+            except Exception as e:
+                logging.warn("Ignoring invalid index '%s': %s" % (index_path, e))
+                index = None
+            if index and index.get('format') == INDEX_FORMAT_VERSION and \
+                    index['size'] <= os.path.getsize(self.path):
+                self.runs = index['runs']
+                self.repos = index['repos']
+                self._repo_runs = index['repo_runs']
+                self._repo_names = index['repo_names']
+                self.versions = index['versions']
+                self.columns = index['columns']
+                self.packages = index['packages']
+                self._state = index['state']
+                self._version_ids = dict([(v, i) for i, v in enumerate(self.versions)])
+                self._column_ids = dict([(c, i) for i, c in enumerate(self.columns)])
+                self._size = index['size']
+        with open(self.path, 'rb') as f:
+            self._catch_up(f)
+
+    def _catch_up(self, f):
+        """
+        Apply the complete records which are not covered by the index.
+        A trailing incomplete record (e.g. one which is being appended) is
+        ignored.
+        @return: the size of the file
+        """
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        while self._size < size:
+            record = self._read_record(f, self._size)
+            if record is None:
+                break
+            self._apply(self._size, record)
+            self._size = f.tell()
+        return size
+
+    def _repair(self, f):
+        """
+        Catch up with the records appended by other writers and truncate an
+        incomplete record of an interrupted run.
+        Must only be called while holding the lock of the log.
+        @return: the offset to append to
+        """
+        with open(self.path, 'rb') as reader:
+            size = self._catch_up(reader)
+        if size < self._size:
+            raise RuntimeError("History '%s' is shorter than its index" % self.path)
+        if self._size < size:
+            logging.warn("Truncating incomplete record at %d of '%s'" % (self._size, self.path))
+            f.truncate(self._size)
+        return self._size
+
+    def _save_index(self):
+        index = {
+            'format': INDEX_FORMAT_VERSION,
+            'size': self._size,
+            'runs': self.runs,
+            'repos': self.repos,
+            'repo_runs': self._repo_runs,
+            'repo_names': self._repo_names,
+            'versions': self.versions,
+            'columns': self.columns,
+            'packages': self.packages,
+            'state': self._state,
+        }
+        index_path = self.path + INDEX_SUFFIX
+        tmp_path = '%s.%d.tmp' % (index_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            cPickle.dump(index, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, index_path)
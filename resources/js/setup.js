@@ -1,12 +1,6 @@
-var QUERY_TRANSFORMS = {
-  'blue': 'class="o"',
-  'red': '<a class="m"></a>',
-  'yellow': 'class="obs"',
-  'gray': '<a class="i"></a>',
-  'red1': '<td><a class="m"></a>',
-  'red2': '</a><a class="m"></a><a',
-  'red3': '<a class="m"></a></td>'
-};
+// Number of rows rendered above and below the visible ones when the rows
+// are loaded from the JSON payload.
+var VIRTUAL_BUFFER_ROWS = 40;
 
 window.body_ready = function() {
   var url_parts = window.location.href.split('?');
@@ -18,6 +12,7 @@ window.body_ready = function() {
         case 'q': window.queries = key_val[1]; break;
         case 's': window.sort = key_val[1]; break;
         case 'r': window.reverse = key_val[1]; break;
+        case 'c': window.columns_query = key_val[1]; break;
       }
     });
   }
@@ -52,7 +47,7 @@ window.tbody_ready = function() {
   $('.search form').on('submit', function() { return false; });
 
   // Hook up click handlers to the keyword shortcuts.
-  $('.search a').on('click', function(e) {
+  $('.search a:not(.platform)').on('click', function(e) {
     e.preventDefault();
     var url_parts = $(this).attr('href').split('?');
     if (url_parts[1]) {
@@ -68,6 +63,20 @@ window.tbody_ready = function() {
     filter_table();
   });
 
+  // Hook up click handlers to the links toggling the columns of a distro
+  // (only on pages which load the columns separately).
+  $('.search a.platform').on('click', function(e) {
+    e.preventDefault();
+    if (!window.page_data) return;
+    var distro = $(this).attr('href').split('=')[1];
+    var distros = $.map(window.SHARD_GROUPS, function(group) {
+      var selected = $.inArray(group[0], window.selected_distros) != -1;
+      if (distro == 'all' || (group[0] == distro) != selected) return group[0];
+      return null;
+    });
+    show_distros(distros);
+  });
+
   // This mouseover handler wires up the tooltip and CI url in a JIT manner
   // when the mouse hovers on a version square. Critically important is that 
   // there's only instance of this handler: on the tbody. 
@@ -87,7 +96,9 @@ window.tbody_ready = function() {
     }
     a.attr('title', repos[repo_num] + ': ' + ver);
     if (repo_num == 0) {
-      var job_url = window.job_url_templates[child_num(a.closest('td')[0]) - window.META_COLUMNS];
+      var column = child_num(a.closest('td')[0]) - window.META_COLUMNS;
+      if (window.visible_columns) column = window.visible_columns[column];
+      var job_url = window.job_url_templates[column];
       var pkg_name_converted = $('td div', tr).text().split(' ')[0].replace(/_/g, '-');
       if (!a.hasClass('i') && !a.hasClass('obs') ) {
         a.attr('href', job_url.replace('{pkg}', pkg_name_converted));
@@ -169,6 +180,29 @@ window.tbody_ready = function() {
 };
 
 window.body_done = function() {
+  if (window.DATA_URL) {
+    // The rows are not part of the page but loaded separately and only the
+    // visible ones are rendered.
+    $("#search-count").text("loading...");
+    $.getJSON(window.DATA_URL, function(data) {
+      window.virtual_rows = true;
+      $(window).on('scroll resize', schedule_render_visible_rows);
+      if (window.SHARD_URLS) {
+        // The cells of each column are loaded separately when the columns
+        // of a distro are shown.
+        window.page_data = data;
+        show_distros(initial_distros());
+      } else {
+        window.rows = rows_from_data(data);
+        console.log("Total rows loaded: " + window.rows.length);
+        filter_table();
+      }
+      $('tbody').show();
+      $('tbody').data('body_done', true);
+      $(window).trigger('resize');
+    });
+    return;
+  }
   if (window.queries || window.sort) {
     filter_table();
   } else {
@@ -179,16 +213,14 @@ window.body_done = function() {
   $('tbody').data('body_done', true);
 }
 
+/* Each row is represented by an array of the html of the row, the sort texts
+ * of the meta columns, the flags of the row (bits of the ROW_FLAGS) and the
+ * lowercased search key. */
 function scan_rows() {
   // TODO: Potentially could make the initial load/search more responsive by having this
   // go in chunks, with timeouts in between.
   window.rows = [];
   $('table tbody tr').each(function() {
-    // Add lowercased version of name (which is the last meta column) for faster case-insensitive search.
-    var name_td = $('td:nth-child(' + window.META_COLUMNS + ')', this);
-    if (name_td.text() && name_td.text().length > 0) {
-      name_td.append(' <span class="ht">' + name_td.text().toLowerCase() + '</span>');
-    }
     var row_info = [$(this).html()];
     for (var i = 1; i <= window.META_COLUMNS; i++) {
       var td = $("td:nth-child(" + i + ")", this);
@@ -196,11 +228,227 @@ function scan_rows() {
       if (sort_text == '') sort_text = td.html();
       row_info.push(sort_text);
     }
+    // The status page precomputes the flags and the search key, for other
+    // pages the plain text of the meta columns is searched.
+    row_info.push(parseInt($(this).attr('data-flags')) || 0);
+    var search_key = $(this).attr('data-search');
+    if (search_key == null) {
+      search_key = row_info.slice(1).join('\n').toLowerCase();
+    }
+    row_info.push(search_key);
     window.rows.push(row_info);
   });
   console.log("Total rows found: " + window.rows.length);
 }
 
+function strip_tags(html) {
+  return html.replace(/<[^>]*>/g, '');
+}
+
+function format_version(version, latest) {
+  var missing = !version || version == 'None';
+  if (latest) {
+    if (missing) return '<a class="m"></a>';
+    // When version is the same as latest, the tooltip handler infers it.
+    if (version == latest) return '<a></a>';
+    return '<a class="o">' + version + '</a>';
+  }
+  if (missing) return '<a class="i"></a>';
+  return '<a class="obs">' + version + '</a>';
+}
+
+/* Expand the run-length-encoded cells of a column fragment generated by
+ * status_page.get_column_data() to the cell index of each row. */
+function get_row_cells(fragment) {
+  if (!fragment.row_cells) {
+    var row_cells = [];
+    for (var k = 0; k < fragment.rows.length; k += 2) {
+      for (var n = 0; n < fragment.rows[k + 1]; n++) {
+        row_cells.push(fragment.rows[k]);
+      }
+    }
+    fragment.row_cells = row_cells;
+  }
+  return fragment.row_cells;
+}
+
+/* Build the same row information as scan_rows() from the JSON payload
+ * generated by status_page.get_status_page_data(). If the payload doesn't
+ * contain the cells they are taken from the fragments of the given columns. */
+function rows_from_data(data, columns, fragments) {
+  var cell_cache = {};
+  // source provides the versions and cells, column distinguishes the
+  // fragments since their cell indices are not unique
+  function format_cell(source, column, cell_id, latest_id) {
+    var key = column + ':' + cell_id + ':' + latest_id;
+    if (!(key in cell_cache)) {
+      var latest = latest_id == -1 ? null : data.versions[latest_id];
+      cell_cache[key] = $.map(source.cells[cell_id], function(version_id) {
+        return format_version(source.versions[version_id], latest);
+      }).join('');
+    }
+    return cell_cache[key];
+  }
+
+  return $.map(data.rows, function(row, r) {
+    var meta = row[0], latest_id = row[3], no_source = row[4], rle = row[5];
+    var row_info = [null];
+    var tds = [];
+    for (var i = 0; i < meta.length; i++) {
+      var text = strip_tags(meta[i]);
+      tds.push('<td>' + meta[i] + '</td>');
+      row_info.push(text == '' ? meta[i] : text);
+    }
+    row_info.push(row[1], row[2]);
+    // no source packages are expected for dry packages and variants
+    function get_expected(column) {
+      return no_source && data.source_columns[column] ? -1 : latest_id;
+    }
+    if (fragments) {
+      $.each(columns, function(i, column) {
+        var fragment = fragments[column];
+        tds.push('<td>' + format_cell(fragment, column, get_row_cells(fragment)[r], get_expected(column)) + '</td>');
+      });
+    } else {
+      var column = 0;
+      for (var k = 0; k < rle.length; k += 2) {
+        for (var n = 0; n < rle[k + 1]; n++, column++) {
+          tds.push('<td>' + format_cell(data, '', rle[k], get_expected(column)) + '</td>');
+        }
+      }
+    }
+    row_info[0] = tds.join('');
+    return [row_info];
+  });
+}
+
+function initial_distros() {
+  var all = $.map(window.SHARD_GROUPS, function(group) { return group[0]; });
+  if (window.columns_query == 'all') return all;
+  var distros = $.map((window.columns_query || '').split(','), function(distro) {
+    return $.inArray(distro, all) == -1 ? null : distro;
+  });
+  // Only show the columns of the first distro by default.
+  return distros.length > 0 ? distros : all.slice(0, 1);
+}
+
+/* Show the columns of the given distros, loading the missing fragments. */
+function show_distros(distros) {
+  window.selected_distros = distros;
+  $('.search a.platform').each(function() {
+    var distro = $(this).attr('href').split('=')[1];
+    $(this).toggleClass('selected', $.inArray(distro, distros) != -1);
+  });
+  var columns = [];
+  $.each(window.SHARD_GROUPS, function(i, group) {
+    if ($.inArray(group[0], distros) != -1) columns = columns.concat(group[1]);
+  });
+  var request = columns.join(',');
+  window.columns_request = request;
+
+  window.fragments = window.fragments || {};
+  var missing = $.map(columns, function(column) {
+    return column in window.fragments ? null : column;
+  });
+  function done() {
+    // ignore the response if other columns have been selected meanwhile
+    if (window.columns_request != request) return;
+    window.visible_columns = columns;
+    show_columns(columns);
+    window.rows = rows_from_data(window.page_data, columns, window.fragments);
+    console.log("Total rows loaded: " + window.rows.length);
+    window.previous_queries = null;
+    filter_table();
+    $(window).trigger('resize');
+  }
+  if (missing.length == 0) {
+    done();
+    return;
+  }
+  $("#search-count").text("loading...");
+  var pending = missing.length;
+  $.each(missing, function(i, column) {
+    $.getJSON(window.SHARD_URLS[column], function(fragment) {
+      window.fragments[column] = fragment;
+      if (--pending == 0) done();
+    });
+  });
+}
+
+/* Hide the headers of all other distro/arch columns. */
+function show_columns(columns) {
+  $('table thead tr').each(function() {
+    $(this).children().each(function(i) {
+      if (i < window.META_COLUMNS) return;
+      $(this).css('display', $.inArray(i - window.META_COLUMNS, columns) == -1 ? 'none' : '');
+    });
+  });
+}
+
+function render_rows(result_rows) {
+  window.result_rows = result_rows;
+  if (!window.virtual_rows) {
+    var result_rows_plain = $.map(result_rows, function(row) { return row[0]; });
+
+    // It's still a nasty rendering pause as the browser crunches through this. A possible
+    // future optimization would be to have multiple tbody elements, chunk up the resulting
+    // rows, and load them in in batches, separated by zero timeouts.
+    $('table tbody').html("<tr/><tr>" + result_rows_plain.join("</tr><tr>") + "</tr>");
+    return;
+  }
+  window.rendered_range = null;
+  render_visible_rows();
+}
+
+function schedule_render_visible_rows() {
+  if (window.render_scheduled) return;
+  window.render_scheduled = true;
+  if (window.requestAnimationFrame) {
+    window.requestAnimationFrame(render_visible_rows);
+  } else {
+    setTimeout(render_visible_rows, 0);
+  }
+}
+
+/* Only render the rows around the visible part of the table, the other rows
+ * are replaced by spacers of the same height. */
+function render_visible_rows() {
+  window.render_scheduled = false;
+  var rows = window.result_rows;
+  if (!rows) return;
+  var tbody = $('table tbody');
+  var row_height = window.row_height || 24;
+  var offset = Math.floor(($(window).scrollTop() - tbody.offset().top) / row_height);
+  var first = Math.min(Math.max(0, offset - VIRTUAL_BUFFER_ROWS), rows.length);
+  // start with an even row to keep the stripes of the rows stable
+  first -= first % 2;
+  var last = Math.min(rows.length, Math.max(first, offset + Math.ceil($(window).height() / row_height) + VIRTUAL_BUFFER_ROWS));
+  var range = first + ':' + last + ':' + rows.length;
+  if (window.rendered_range == range) return;
+  window.rendered_range = range;
+
+  function spacer(count) {
+    var column_count = (window.visible_columns || window.job_url_templates).length;
+    return '<tr class="spacer"><td colspan="' + (column_count + window.META_COLUMNS) +
+      '" style="height: ' + (count * row_height) + 'px; padding: 0"></td></tr>';
+  }
+  var html = [spacer(first)];
+  for (var i = first; i < last; i++) {
+    html.push('<tr>' + rows[i][0] + '</tr>');
+  }
+  html.push(spacer(rows.length - last));
+  tbody.html(html.join(''));
+
+  if (!window.row_height && last > first) {
+    // measure the actual height of a row once
+    window.row_height = tbody.children().eq(1).height() || row_height;
+    if (window.row_height != row_height) {
+      window.rendered_range = null;
+      render_visible_rows();
+    }
+  }
+}
+
 function filter_table() {
   // One time setup, to build up the array of row contents combined with sortable fields.
   if (!window.rows) { scan_rows(); }
@@ -215,12 +463,9 @@ function filter_table() {
       if (q.length < 3) return null;
       
       // Terms to lowercase.
-      q = q.toLowerCase();
-
-      // Transform "magic" queries as necessary.
-      return QUERY_TRANSFORMS[q] || q;
+      return q.toLowerCase();
     });
-    
+
     if (window.previous_queries && window.previous_queries.toString() == queries.toString() &&
         window.previous_sort == window.sort &&
         window.previous_reverse == window.reverse) {
@@ -234,29 +479,22 @@ function filter_table() {
 
     if (queries.length > 0) {
       console.log("Filtering for queries:", queries);
+      // "Magic" queries like "red" or "sync" test the flags of the rows, all
+      // other terms are searched in the search keys.
+      var row_flags = window.ROW_FLAGS || [];
+      var mask = 0;
+      var terms = $.map(queries, function(q) {
+        var bit = $.inArray(q, row_flags);
+        if (bit == -1) return q;
+        mask |= 1 << bit;
+        return null;
+      });
+      var flags_index = window.META_COLUMNS + 1;
       result_rows = $.map(window.rows, function(row) {
-        for (var i = 0; i < queries.length; i++) {
-          var is_known_query = false
-          for(var q in QUERY_TRANSFORMS) {
-            if (queries[i] === QUERY_TRANSFORMS[q]) {
-              is_known_query = true;
-              break;
-            }
-          }
-          if(is_known_query) {
-            // search in full row html
-            if (row[0].indexOf(queries[i]) == -1) return null;
-          } else {
-            // search in plain text of each column
-            match = false;
-            for (var j = 1; j < row.length; j++) {
-              if (row[j] && row[j].indexOf(queries[i]) != -1) {
-                match = true;
-                break;
-              }
-            }
-            if (!match) return null;
-          }
+        if ((row[flags_index] & mask) != mask) return null;
+        var search_key = row[flags_index + 1];
+        for (var i = 0; i < terms.length; i++) {
+          if (search_key.indexOf(terms[i]) == -1) return null;
         }
         return [row];
       });
@@ -283,18 +521,14 @@ function filter_table() {
     });
   }
 
-  var result_rows_plain = $.map(result_rows, function(row) { return row[0]; });
-
-  // It's still a nasty rendering pause as the browser crunches through this. A possible
-  // future optimization would be to have multiple tbody elements, chunk up the resulting
-  // rows, and load them in in batches, separated by zero timeouts.
-  $('table tbody').html("<tr/><tr>" + result_rows_plain.join("</tr><tr>") + "</tr>");
+  render_rows(result_rows);
 
   if (window.history && window.history.replaceState) {
     var qs = [];
     if (window.queries) qs.push("q=" + window.queries);
     if (window.sort) qs.push("s=" + window.sort);
     if (window.reverse) qs.push("r=" + window.reverse);
+    if (window.selected_distros) qs.push("c=" + window.selected_distros.join(','));
     var url = document.location.origin + document.location.pathname
     if (qs.length > 0) {
       url += "?" + qs.join("&");
@@ -1,4 +1,5 @@
 @{
+import json
 import time
 }
 <!DOCTYPE html>
@@ -11,7 +12,15 @@ import time
   <script type="text/javascript">
     window.META_COLUMNS = 6;
     window.repos = @(repr(repos));
+    window.ROW_FLAGS = @(repr(row_flags));
     window.job_url_templates = @(repr([c['job_url'] for c in metadata_columns[4:]]));
+@[if data_url]@
+    window.DATA_URL = '@(data_url)';
+@[end if]@
+@[if shard_urls]@
+    window.SHARD_URLS = @(json.dumps(shard_urls));
+    window.SHARD_GROUPS = @(json.dumps(shard_groups));
+@[end if]@
   </script>
   <script type="text/javascript" src="@(resource_path)/js/setup.js?@(resource_hashes['setup.js'])"></script>
 
@@ -57,6 +66,12 @@ import time
         <a href="?q=yellow">yellow</a>,
         <a href="?q=gray">gray</a>
       </p>
+@[if shard_groups]@
+      <p>Platforms:
+        <a class="platform" href="?c=all" title="Show the columns of all distros">all</a>@[for distro, columns in shard_groups],
+        <a class="platform" href="?c=@(distro)" title="Toggle the columns of @(distro)">@(distro)</a>@[end for]
+      </p>
+@[end if]@
       <p id="search-count"></p>
     </form>
   </div>
@@ -71,7 +86,7 @@ import time
     <tbody>
       <script type="text/javascript">window.tbody_ready();</script>
 @[for row in rows]@
-      <tr>@[for cell in row]<td>@(cell)</td>@[end for]</tr>
+      @(row)
 @[end for]@
     </tbody>
   </table>
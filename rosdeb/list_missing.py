@@ -49,6 +49,7 @@ import tempfile
 import time
 import rospkg.distro
 
+from buildfarm import http_client
 from core import debianize_name, debianize_version
 from repo import deb_in_repo, load_Packages, get_repo_version, get_stack_version, BadRepo
 
@@ -88,7 +89,7 @@ def load_info(stack_name, stack_version):
         if url in _distro_yaml_cache:
             return _distro_yaml_cache[url]
         else:
-            _distro_yaml_cache[url] = l = yaml.load(urllib2.urlopen(url))
+            _distro_yaml_cache[url] = l = yaml.load(http_client.fetch(url))
             return l
     except:
         raise Exception("Problem fetching yaml info for %s %s (%s)"%(stack_name, stack_version, url))
@@ -145,7 +146,7 @@ def compute_deps(distro, stack_name, ignore_catkinized = True):
 class ExclusionList(object):
     def __init__(self, uri, distro_name, os_platform, arch):
         try:
-            self.excludes = yaml.load(urllib2.urlopen(uri).read()) or {}
+            self.excludes = yaml.load(http_client.fetch(uri)) or {}
         except urllib2.HTTPError:
             self.excludes = {}
         self.key = "%s-%s"%(os_platform,arch)
@@ -37,7 +37,8 @@ Utilities for reading state from a debian repo
 """
 
 import urllib2
-import re
+
+from buildfarm.repo import PackagesIndex
 
 from .core import debianize_name
 
@@ -99,17 +100,27 @@ def load_Packages(repo_url, os_platform, arch, cache=None):
     """
     return parse_Packages(get_Packages(repo_url, os_platform, arch, cache))
 
+def get_packages_index(repo_url, os_platform, arch, cache=None):
+    """
+    Return the PackagesIndex of the package list. It is built only once
+    and stored in the cache next to the list.
+    @raise BadRepo: if repo does not exist
+    """
+    if cache is None:
+        cache = _Packages_cache
+    key = ('index', repo_url, os_platform, arch)
+    if not key in cache:
+        cache[key] = PackagesIndex(get_Packages(repo_url, os_platform, arch, cache))
+    return cache[key]
+
 def deb_in_repo(repo_url, deb_name, deb_version, os_platform, arch, use_regex=True, cache=None):
     """
+    @param deb_version: regular expression matching the whole version if
+      use_regex is True, otherwise a prefix of the version
     @param cache: dictionary to store Packages list for caching
     """
-    packagelist = get_Packages(repo_url, os_platform, arch, cache)
-    if not use_regex:
-        s = 'Package: %s\nVersion: %s'%(deb_name, deb_version)
-        return s in packagelist
-    else:
-        M = re.search('^Package: %s\nVersion: %s$'%(deb_name, deb_version), packagelist, re.MULTILINE)
-        return M is not None
+    index = get_packages_index(repo_url, os_platform, arch, cache)
+    return index.has_version(deb_name, deb_version, use_regex)
 
 def get_depends(repo_url, deb_name, os_platform, arch):
     """
@@ -153,6 +164,5 @@ def get_repo_version(repo_url, distro, os_platform, arch):
     """
     Return the greatest build-stamp for any deb in the repository
     """
-    packagelist = load_Packages(repo_url, os_platform, arch)
-    return max(['0'] + [x[1][x[1].find('-')+1:x[1].find('~')] for x in packagelist if x[3] == distro.release_name])
-
+    index = get_packages_index(repo_url, os_platform, arch)
+    return max(['0'] + [v[v.find('-')+1:v.find('~')] for v in index.get_rosdistro_versions(distro.release_name)])
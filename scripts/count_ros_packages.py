@@ -16,6 +16,9 @@ def parse_options():
     parser.add_argument('--repo', dest='repo_url', action='store', default='http://repos.ros.org/repos/building',
                         help='The repo url')
 
+    parser.add_argument('--cache-dir', dest='cache_dir', action='store', default=None,
+                        help='Directory to keep the package list in, it is updated incrementally on later calls')
+
     parser.add_argument('--count', dest='count', action='store', default=100,
                         help='Min numberof packages')
 
@@ -27,7 +30,7 @@ def parse_options():
 if __name__ == "__main__":
     args = parse_options()
 
-    count = buildfarm.repo.count_packages(args.repo_url, args.rosdistro, args.distro, args.arch)
+    count = buildfarm.repo.count_packages(args.repo_url, args.rosdistro, args.distro, args.arch, cache_dir=args.cache_dir)
     print("Found %d packages matching: %s" % (count, args))
 
     min_num = int(args.count)
@@ -7,7 +7,8 @@ import os
 import sys
 import time
 
-from buildfarm.compare_page import generate_html
+from buildfarm.compare_page import write_html
+from buildfarm.precompress import brotli, replace_file
 from rosdistro import get_index, get_index_url
 
 
@@ -18,10 +19,16 @@ def parse_options(args=sys.argv[1:]):
                    help='Root directory containing generated files.')
     p.add_argument('--resources', default='.',
                    help='Path to resources (e.g. css and js files).')
+    p.add_argument('--brotli', action='store_true',
+                   help='Write a brotli compressed copy of the generated'
+                   ' page in addition to the gzip compressed one.')
     p.add_argument('rosdistros', nargs='*', default=[],
                    help='The ROS distros to generate the compare page'
                    ' for (i.e. groovy hydro indigo).')
-    return p.parse_args(args)
+    args = p.parse_args(args)
+    if args.brotli and brotli is None:
+        p.error("'--brotli' requires the 'brotli' module")
+    return args
 
 
 if __name__ == '__main__':
@@ -43,9 +50,10 @@ if __name__ == '__main__':
     html_file = os.path.join(args.basedir, 'compare_%s.html' % '_'.join(args.rosdistros))
     print("Generating '%s' file..." % html_file)
     template_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'resources', 'compare_page.html.em')
-    html = generate_html(index, args.rosdistros, start_time, template_file, args.resources)
-    with open(html_file, 'w') as f:
-        f.write(html)
+    tmp_file = '%s.%d.tmp' % (html_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        write_html(f, index, args.rosdistros, start_time, template_file, args.resources)
+    replace_file(tmp_file, html_file, compress=True, use_brotli=args.brotli)
 
     print('Symlinking js and css...')
     for res in ['js', 'css']:
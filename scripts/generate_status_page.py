@@ -3,12 +3,19 @@
 from __future__ import print_function
 
 import argparse
+import multiprocessing
 import os
 import sys
 import time
+import traceback
 
-from buildfarm.apt_data import get_version_data
-from buildfarm.status_page import get_distro_arches, render_csv, transform_csv_to_html
+from buildfarm import http_client
+from buildfarm.apt_data import get_apt_data, make_name_filter, RosdistroData
+from buildfarm.precompress import brotli, replace_file
+from buildfarm.release_watcher import ReleaseWatcher
+from buildfarm.status_metrics import get_status_metrics, write_status_metrics
+from buildfarm.status_page import get_debian_name_prefixes, get_distro_arches, get_versions_table, REPOS, VersionsTable, write_status_page
+from buildfarm.version_history import VersionHistory
 from rosdistro import get_cached_distribution, get_index, get_index_url
 
 JENKINS_HOST = 'http://jenkins.ros.org'
@@ -22,13 +29,65 @@ def parse_options(args=sys.argv[1:]):
                    ' This should be created using the build_caches command.')
     p.add_argument('--skip-fetch', action='store_true',
                    help='Skip fetching the apt data.')
+    p.add_argument('--skip-unchanged', action='store_true',
+                   help='Only download the apt data which has changed'
+                   ' according to the checksums in the Release files.')
+    p.add_argument('--pdiff', action='store_true',
+                   help='Update previously downloaded apt data using the'
+                   ' incremental diffs of the repositories.')
+    p.add_argument('--fetch-jobs', type=int, default=4,
+                   help='Number of apt list files to download concurrently.')
+    p.add_argument('--no-snapshot', action='store_true',
+                   help='Do not reuse the apt data parsed in previous runs'
+                   ' (stored per set of rosdistros and distros).')
     p.add_argument('--skip-csv', action='store_true',
-                   help='Skip generating .csv file.')
+                   help='Skip generating the versions table and reuse the'
+                   ' one (or the .csv file) of a previous run.')
+    p.add_argument('--no-csv', action='store_true',
+                   help='Do not export the versions table as .csv file.')
+    p.add_argument('--no-history', action='store_true',
+                   help='Do not append the changed versions to the history'
+                   ' of the rosdistro (see query_version_history.py).')
+    p.add_argument('--no-row-cache', action='store_true',
+                   help='Render all rows again instead of only the ones which'
+                   ' have changed since the previous run. No delta file is'
+                   ' written in this case.')
+    p.add_argument('--static-rows', action='store_true',
+                   help='Render all rows into the .html file instead of a'
+                   ' .json file which is rendered by the browser.')
+    p.add_argument('--shard', action='store_true',
+                   help='Write the cells of each distro/arch column to a'
+                   ' separate .json file which the browser only loads for'
+                   ' the selected distros.')
+    p.add_argument('--brotli', action='store_true',
+                   help='Write brotli compressed copies of the generated'
+                   ' pages and data files in addition to the gzip compressed'
+                   ' ones.')
+    p.add_argument('--no-metrics', action='store_true',
+                   help='Do not write the summary and timing metrics of each'
+                   ' page (<rosdistro>.metrics.json / .prom).')
     p.add_argument('--resources', default='.',
                    help='Path to resources (e.g. css and js files).')
-    p.add_argument('rosdistro', default='groovy',
-                   help='The ROS distro to generate the status page'
-                   ' for (i.e. groovy).')
+    p.add_argument('--watch', action='store_true',
+                   help='Keep running and generate the pages again whenever'
+                   ' one of the repos has been republished.')
+    p.add_argument('--poll-interval', type=int, default=60,
+                   help='Seconds between polling the Release files of the'
+                   ' repos in watch mode.')
+    p.add_argument('--debounce', type=int, default=120,
+                   help='Seconds without any further publish to wait for'
+                   ' after a repo has been republished in watch mode.')
+    p.add_argument('rosdistros', metavar='rosdistro', nargs='+',
+                   help='The ROS distros to generate the status page'
+                   ' for (i.e. groovy). The apt data is only fetched and'
+                   ' parsed once for all of them.')
+    p.add_argument('--render-jobs', type=int, default=1,
+                   help='Number of processes rendering the pages of'
+                   ' different ROS distros in parallel.')
+    p.add_argument('--format-jobs', type=int, default=1,
+                   help='Number of processes formatting the rows of a page'
+                   ' in parallel. Ignored if the pages are rendered in'
+                   ' parallel (see --render-jobs).')
     p.add_argument('--build-repo',
                    default='http://repos.ros.org/repos/building',
                    help='Repository URL for the build farm repository.')
@@ -48,49 +107,25 @@ def parse_options(args=sys.argv[1:]):
     p.add_argument('--da',
                    nargs='+',
                    help='Distro/Arch pairs to query')
-    return p.parse_args(args)
+    args = p.parse_args(args)
+    if args.brotli and brotli is None:
+        p.error("'--brotli' requires the 'brotli' module")
+    if args.shard and args.static_rows:
+        p.error("'--shard' can not be combined with '--static-rows'")
+    if args.watch and (args.skip_fetch or args.skip_csv):
+        p.error("'--watch' can not be combined with '--skip-fetch' or '--skip-csv'")
+    return args
 
 
-if __name__ == '__main__':
-    args = parse_options()
-
-    start_time = time.localtime()
-
-    ros_repos = {'ros': args.public_repo,
-                 'shadow-fixed': args.shadow_repo,
-                 'building': args.build_repo}
-
-    distro_arches = []
-    if args.da:
-        distro_arches = [tuple(a.split(',')) for a in args.da]
-    elif args.distros:
-        distro_arches = [(d, a) for d in args.distros for a in args.arches]
-    else:
-        distro_arches = get_distro_arches(args.arches, args.rosdistro)
-
-    csv_file = os.path.join(args.basedir, '%s.csv' % args.rosdistro)
-    if not args.skip_csv:
-        print('Assembling apt version cache')
-        rd_data, apt_data = get_version_data(args.basedir, args.rosdistro,
-                                             ros_repos, distro_arches,
-                                             apt_update=not args.skip_fetch)
-        print('Generating .csv file...')
-        render_csv(rd_data, apt_data, csv_file, args.rosdistro,
-                   distro_arches, ros_repos)
-    elif not os.path.exists(csv_file):
-        print('.csv file "%s" is missing. Call script without "--skip-csv".' %
-              csv_file, file=sys.stderr)
-    else:
-        print('Skip generating .csv file')
-
+def get_metadata_builder(rosdistro):
     def metadata_builder(column_data):
         build_argstring = column_data.split('_')
         distro = build_argstring[0]
         arch = build_argstring[1]
         is_source = arch == 'source'
         data = {
-            'rosdistro': args.rosdistro,
-            'rosdistro_short': args.rosdistro[0].upper(),
+            'rosdistro': rosdistro,
+            'rosdistro_short': rosdistro[0].upper(),
             'distro': distro,
             'distro_short': distro[0].upper(),
             'is_source': is_source
@@ -120,21 +155,153 @@ if __name__ == '__main__':
         data['job_url'] = ('{view_url}job/%s/' % job_name).format(**data)
 
         return data
+    return metadata_builder
+
+
+def generate_status_page(args, rosdistro, distro_arches, ros_repos, apt_data, start_time, timings):
+    # the durations of the phases of this page in addition to the shared ones
+    timings = dict(timings)
+    phase_start_time = time.time()
+    table_file = os.path.join(args.basedir, '%s.table' % rosdistro)
+    csv_file = os.path.join(args.basedir, '%s.csv' % rosdistro)
+    if apt_data is not None:
+        print('Generating versions table for %s...' % rosdistro)
+        rd_data = RosdistroData(rosdistro)
+        versions_table = get_versions_table(rd_data, apt_data, rosdistro,
+                                            distro_arches, ros_repos)
+        versions_table.save(table_file)
+        if not args.no_csv:
+            tmp_file = '%s.%d.tmp' % (csv_file, os.getpid())
+            with open(tmp_file, 'w') as f:
+                versions_table.write_csv(f)
+            replace_file(tmp_file, csv_file, compress=True, use_brotli=args.brotli)
+        if not args.no_history:
+            history_file = os.path.join(args.basedir, '%s.history' % rosdistro)
+            VersionHistory(history_file).append(versions_table, int(time.mktime(start_time)), REPOS)
+    elif os.path.exists(table_file):
+        print('Skip generating versions table for %s' % rosdistro)
+        versions_table = VersionsTable.load(table_file)
+    elif os.path.exists(csv_file):
+        print('Skip generating versions table for %s, reading .csv file' % rosdistro)
+        with open(csv_file, 'r') as f:
+            versions_table = VersionsTable.from_csv(f)
+    else:
+        # not exiting since this might run in a process of a pool
+        raise RuntimeError('Versions table "%s" is missing. Call script without "--skip-csv".' %
+                           table_file)
+    timings['table'] = time.time() - phase_start_time
 
-    if args.rosdistro != 'fuerte':
+    phase_start_time = time.time()
+    if rosdistro != 'fuerte':
         index = get_index(get_index_url())
-        cached_distribution = get_cached_distribution(index, args.rosdistro)
+        cached_distribution = get_cached_distribution(index, rosdistro)
     else:
         cached_distribution = None
+    timings['rosdistro'] = time.time() - phase_start_time
 
-    print('Transforming .csv into .html file...')
+    print('Transforming versions table into .html file for %s...' % rosdistro)
     template_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'resources', 'status_page.html.em')
-    with open(csv_file, 'r') as f:
-        html = transform_csv_to_html(f, metadata_builder, args.rosdistro,
-                                     start_time, template_file, args.resources, cached_distribution)
-    html_file = os.path.join(args.basedir, '%s.html' % args.rosdistro)
-    with open(html_file, 'w') as f:
-        f.write(html)
+    row_cache_file = None
+    delta_file = None
+    if not args.no_row_cache:
+        row_cache_file = os.path.join(args.basedir, '%s.rows' % rosdistro)
+        delta_file = os.path.join(args.basedir, '%s.delta.json' % rosdistro)
+    data_file = None
+    if not args.static_rows:
+        data_file = os.path.join(args.basedir, '%s.json' % rosdistro)
+    phase_start_time = time.time()
+    html_file = os.path.join(args.basedir, '%s.html' % rosdistro)
+    # write the page next to the previous one and replace it when complete
+    tmp_file = '%s.%d.tmp' % (html_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        write_status_page(f, versions_table, get_metadata_builder(rosdistro), rosdistro,
+                          start_time, template_file, args.resources, cached_distribution,
+                          row_cache_file=row_cache_file, delta_file=delta_file,
+                          data_file=data_file, jobs=args.format_jobs, sharded=args.shard,
+                          precompress=True, use_brotli=args.brotli)
+    # the compressed copies are written before replacing the page
+    replace_file(tmp_file, html_file, compress=True, use_brotli=args.brotli)
+    timings['render'] = time.time() - phase_start_time
+
+    if not args.no_metrics:
+        metrics = get_status_metrics(rosdistro, start_time, versions_table, timings)
+        write_status_metrics(os.path.join(args.basedir, '%s.metrics' % rosdistro), metrics)
+    print('Generated .html file "%s"' % html_file)
+    return html_file
+
+
+# state shared with the forked render processes
+_render_context = {}
+
+
+def _generate_status_page(rosdistro):
+    context = _render_context
+    return generate_status_page(context['args'], rosdistro,
+                                context['distro_arches'][rosdistro],
+                                context['ros_repos'], context['apt_data'],
+                                context['start_time'], context['timings'])
+
+
+def generate_status_pages(args, ros_repos, distro_arches):
+    start_time = time.localtime()
+
+    # durations of the phases shared by all pages
+    timings = {}
+    apt_data = None
+    if not args.skip_csv:
+        # fetch and parse the apt data of all rosdistros only once
+        all_distro_arches = []
+        for rosdistro in args.rosdistros:
+            for da in distro_arches[rosdistro]:
+                if da not in all_distro_arches:
+                    all_distro_arches.append(da)
+        # ignore all packages which are not shown on any of the pages
+        name_filter = None
+        prefixes = get_debian_name_prefixes(args.rosdistros)
+        if prefixes:
+            name_filter = make_name_filter(prefixes)
+        print('Assembling apt version cache')
+        apt_data = get_apt_data(args.basedir, ros_repos, all_distro_arches,
+                                apt_update=not args.skip_fetch,
+                                skip_unchanged=args.skip_unchanged,
+                                jobs=args.fetch_jobs,
+                                snapshot_file=None if args.no_snapshot else os.path.join(args.basedir, 'apt_data.pickle'),
+                                use_pdiff=args.pdiff,
+                                name_filter=name_filter,
+                                timings=timings)
+    else:
+        # check before rendering any page (possibly in a pool)
+        for rosdistro in args.rosdistros:
+            table_file = os.path.join(args.basedir, '%s.table' % rosdistro)
+            csv_file = os.path.join(args.basedir, '%s.csv' % rosdistro)
+            if not os.path.exists(table_file) and not os.path.exists(csv_file):
+                print('Versions table "%s" is missing. Call script without "--skip-csv".' %
+                      table_file, file=sys.stderr)
+                sys.exit(1)
+
+    _render_context.update({
+        'args': args,
+        'distro_arches': distro_arches,
+        'ros_repos': ros_repos,
+        'apt_data': apt_data,
+        'start_time': start_time,
+        'timings': timings,
+    })
+    if args.render_jobs > 1 and len(args.rosdistros) > 1:
+        if args.format_jobs > 1:
+            # the processes of a pool can not start their own pools
+            print("Ignoring '--format-jobs' since the pages are rendered in parallel")
+            args.format_jobs = 1
+        # the forked processes share the parsed apt data
+        pool = multiprocessing.Pool(min(args.render_jobs, len(args.rosdistros)))
+        try:
+            pool.map(_generate_status_page, args.rosdistros)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for rosdistro in args.rosdistros:
+            _generate_status_page(rosdistro)
 
     print('Symlinking js and css...')
     for res in ['js', 'css']:
@@ -144,4 +311,56 @@ if __name__ == '__main__':
                                'resources', res)
             os.symlink(os.path.abspath(src), dst)
 
-    print('Generated .html file "%s"' % html_file)
+    http_client.dump_stats()
+    http_client.reset_stats()
+
+
+def watch(args, ros_repos, distro_arches):
+    """
+    Generate the status pages whenever one of the repos has been republished.
+    """
+    distros = sorted(set([d for das in distro_arches.values() for d, _ in das]))
+    watcher = ReleaseWatcher(ros_repos.values(), distros)
+    watcher.poll()
+    while True:
+        try:
+            generate_status_pages(args, ros_repos, distro_arches)
+        except Exception:
+            # keep watching, the next publish might fix the problem
+            traceback.print_exc()
+        # the requests of the polls are not part of the statistics of a
+        # regeneration, forget them so that they do not accumulate
+        while not watcher.poll():
+            http_client.reset_stats()
+            time.sleep(args.poll_interval)
+        # coalesce bursts of publishes (e.g. of multiple distros) into a
+        # single regeneration, which only starts once the Release files have
+        # not changed for a whole debounce interval
+        changed = True
+        while changed:
+            print('Repos have been republished, waiting %d seconds for further changes...' % args.debounce)
+            time.sleep(args.debounce)
+            changed = watcher.poll()
+            http_client.reset_stats()
+
+
+if __name__ == '__main__':
+    args = parse_options()
+
+    ros_repos = {'ros': args.public_repo,
+                 'shadow-fixed': args.shadow_repo,
+                 'building': args.build_repo}
+
+    distro_arches = {}
+    for rosdistro in args.rosdistros:
+        if args.da:
+            distro_arches[rosdistro] = [tuple(a.split(',')) for a in args.da]
+        elif args.distros:
+            distro_arches[rosdistro] = [(d, a) for d in args.distros for a in args.arches]
+        else:
+            distro_arches[rosdistro] = get_distro_arches(args.arches, rosdistro)
+
+    if args.watch:
+        watch(args, ros_repos, distro_arches)
+    else:
+        generate_status_pages(args, ros_repos, distro_arches)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+from buildfarm.version_history import VERSION_COLUMN, VersionHistory
+
+
+def parse_options(args=sys.argv[1:]):
+    p = argparse.ArgumentParser(description='Show when the versions of a'
+                                ' package have changed in the repos, based on'
+                                ' the history recorded by'
+                                ' generate_status_page.py.')
+    p.add_argument('--basedir', default='/tmp/build_status_page',
+                   help='Root directory containing generated files.')
+    p.add_argument('rosdistro',
+                   help='The ROS distro (i.e. hydro).')
+    p.add_argument('package',
+                   help='The name of the package.')
+    p.add_argument('--column', action='append',
+                   help='Only show the changes of this distro/arch column'
+                   ' (i.e. precise_amd64), can be passed multiple times.'
+                   ' The column "%s" contains the version in the'
+                   ' rosdistro.' % VERSION_COLUMN)
+    p.add_argument('--repo',
+                   help='Only show the changes in this repo (i.e. shadow-fixed).')
+    return p.parse_args(args)
+
+
+def format_timeline(timeline, columns=None, repo=None):
+    """
+    Return a line for each changed version of the timeline of a package.
+    """
+    lines = []
+    # the versions of each column by repo name after the previous change
+    current = {}
+    for timestamp, column, versions, repos in timeline:
+        if column is None:
+            # the package has been removed
+            changes = [(c, None) for c in sorted(current.keys())]
+        else:
+            changes = [(column, versions)]
+        for column, versions in changes:
+            names = ['rosdistro'] if column == VERSION_COLUMN else list(repos)
+            old = current.pop(column, {})
+            new = {}
+            if versions is not None:
+                new = dict(zip(names, versions))
+                current[column] = new
+            if columns and column not in columns:
+                continue
+            # repos which are not used anymore are shown as removed
+            for name in names + sorted([n for n in old if n not in names]):
+                old_version = str(old.get(name))
+                new_version = str(new.get(name))
+                if old_version == new_version or (repo and name != repo):
+                    continue
+                lines.append('%s  %-16s %-14s %s -> %s' %
+                             (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)),
+                              column, name, old_version, new_version))
+    return lines
+
+
+if __name__ == '__main__':
+    args = parse_options()
+
+    history_file = os.path.join(args.basedir, '%s.history' % args.rosdistro)
+    if not os.path.exists(history_file):
+        print("History '%s' does not exist" % history_file, file=sys.stderr)
+        sys.exit(1)
+    history = VersionHistory(history_file)
+    if args.package not in history.packages:
+        print("Package '%s' is not part of the history of %d runs" %
+              (args.package, len(history.runs)), file=sys.stderr)
+        sys.exit(1)
+
+    for line in format_timeline(history.get_timeline(args.package), args.column, args.repo):
+        print(line)
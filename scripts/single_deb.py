@@ -49,6 +49,7 @@ import re
 import time
 
 from rospkg.distro import distro_uri, load_distro
+from buildfarm import http_client
 import rosdeb
 from rosdeb import debianize_name, debianize_version, targets, list_missing
 from rosdeb.source_deb import download_control
@@ -634,7 +635,7 @@ def gen_metapkgs(distro, os_platform, arch, staging_dir, repo_fqdn, force=False)
     # Retrieve the package list from the shadow repo
     packageurl = repo_url(repo_fqdn) + "/dists/%(os_platform)s/main/binary-%(arch)s/Packages" % locals()
     try:
-        packagetxt = urllib2.urlopen(packageurl).read()
+        packagetxt = http_client.fetch(packageurl)
     except urllib2.URLError as ex:
         print("Failed to open url: %s with error %s" % (packageurl, ex))
         raise ex
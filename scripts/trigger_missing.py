@@ -6,7 +6,7 @@ import argparse
 import jenkins
 import pprint
 
-from buildfarm import jenkins_support, release_jobs
+from buildfarm import http_client, jenkins_support, release_jobs
 from buildfarm.ros_distro import debianize_package_name
 
 
@@ -87,6 +87,7 @@ if __name__ == '__main__':
     print('Missing packages:')
     pp = pprint.PrettyPrinter()
     pp.pprint(missing)
+    http_client.dump_stats()
 
     if args.commit:
         jenkins_instance = jenkins_support.JenkinsConfig_to_handle(jenkins_support.load_server_config_file(jenkins_support.get_default_catkin_debs_config()))
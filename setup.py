@@ -23,6 +23,7 @@ setup(
         'scripts/create_static_jobs.py',
         'scripts/generate_sourcedeb',
         'scripts/generate_status_page.py',
+        'scripts/query_version_history.py',
         'scripts/setup_apt_root.py',
         'scripts/trigger_missing.py'],
     package_data={'buildfarm': ['resources/templates/*.em',
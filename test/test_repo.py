@@ -0,0 +1,88 @@
+from buildfarm import repo
+
+REPO_URL = 'http://example.com/repos/building'
+
+PACKAGES = """\
+Package: ros-hydro-foo
+Version: 1.2.3-0precise-20130601-1200-+0000
+Architecture: amd64
+Depends: libc6
+Wg-Rosdistro: hydro
+
+Package: ros-hydro-foo
+Version: 1.2.4-0precise-20130602-1200-+0000
+Architecture: amd64
+Wg-Rosdistro: hydro
+"""
+
+SOURCES = """\
+Package: ros-hydro-foo
+Format: 3.0 (quilt)
+Binary: ros-hydro-foo
+Architecture: any
+Version: 1.2.3-0precise-20130601-1200
+"""
+
+
+def _get_cache():
+    return {
+        repo._get_Packages_url(REPO_URL, 'precise', 'amd64'): PACKAGES,
+        repo._get_Sources_url(REPO_URL, 'precise'): SOURCES,
+    }
+
+
+def test_deb_in_repo():
+    cache = _get_cache()
+    assert repo.deb_in_repo(REPO_URL, 'ros-hydro-foo', '1.2.3-0.*', 'precise', 'amd64', cache=cache)
+    assert repo.deb_in_repo(REPO_URL, 'ros-hydro-foo', '1.2.4-0.*', 'precise', 'amd64', cache=cache)
+    # the pattern has to match the whole version
+    assert not repo.deb_in_repo(REPO_URL, 'ros-hydro-foo', '1.2.3-0', 'precise', 'amd64', cache=cache)
+    assert not repo.deb_in_repo(REPO_URL, 'ros-hydro-foo', '1.2.5-0.*', 'precise', 'amd64', cache=cache)
+    assert not repo.deb_in_repo(REPO_URL, 'ros-hydro-bar', '.*', 'precise', 'amd64', cache=cache)
+    # without regex the version is a prefix
+    assert repo.deb_in_repo(REPO_URL, 'ros-hydro-foo', '1.2.3-0', 'precise', 'amd64', use_regex=False, cache=cache)
+    assert not repo.deb_in_repo(REPO_URL, 'ros-hydro-foo', '1.2.3-0.*', 'precise', 'amd64', use_regex=False, cache=cache)
+
+
+def test_deb_in_repo_source():
+    cache = _get_cache()
+    # as used by release_jobs.compute_missing() the pattern only has to
+    # match the beginning of the version
+    assert repo.deb_in_repo(REPO_URL, 'ros-hydro-foo', '1.2.3-0' + 'precise', 'precise', 'na', cache=cache, source=True)
+    assert repo.deb_in_repo(REPO_URL, 'ros-hydro-foo', '1.2.3-0precise-20130601-1200', 'precise', 'na', cache=cache, source=True)
+    assert not repo.deb_in_repo(REPO_URL, 'ros-hydro-foo', '1.2.4-0precise', 'precise', 'na', cache=cache, source=True)
+    assert not repo.deb_in_repo(REPO_URL, 'ros-hydro-foo', '0precise', 'precise', 'na', cache=cache, source=True)
+
+
+def test_packages_index():
+    index = repo.PackagesIndex(PACKAGES)
+    assert 'ros-hydro-foo' in index
+    assert index.count('ros-hydro-') == 2
+    assert index.count('ros-groovy-') == 0
+    assert index.get_versions('ros-hydro-foo') == [
+        '1.2.3-0precise-20130601-1200-+0000', '1.2.4-0precise-20130602-1200-+0000']
+    # like parse_Packages() only paragraphs with dependencies are considered
+    assert index.get_rosdistro_versions('hydro') == ['1.2.3-0precise-20130601-1200-+0000']
+    assert index.get_rosdistro_versions('groovy') == []
+
+
+def test_get_repo_version():
+    class Distro(object):
+        release_name = 'hydro'
+    url = repo._get_Packages_url(REPO_URL, 'precise', 'amd64')
+    repo._Packages_cache[url] = """\
+Package: ros-hydro-foo
+Version: 1.2.3-s1370000000~precise
+Depends: libc6
+Wg-Rosdistro: hydro
+
+Package: ros-hydro-bar
+Version: 0.1.0-s1380000000~precise
+Wg-Rosdistro: hydro
+"""
+    try:
+        # the paragraph without a Depends field is ignored
+        assert repo.get_repo_version(REPO_URL, Distro(), 'precise', 'amd64') == 's1370000000'
+    finally:
+        repo._Packages_cache.pop(url)
+        repo._Packages_cache.pop(('index', url))
@@ -0,0 +1,159 @@
+import os
+import shutil
+import tempfile
+
+from buildfarm.version_history import INDEX_SUFFIX, VERSION_COLUMN, VersionHistory
+
+REPOS = ['building', 'testing', 'public']
+
+_tmpdir = None
+
+
+class Codes(list):
+    # mimics the numpy array of the codes of a versions table
+
+    def tolist(self):
+        return list(self)
+
+
+class VersionsTable(object):
+
+    def __init__(self, packages, columns):
+        """
+        @param packages: list of (name, version, cells) tuples with cells
+          being a tuple of the versions in each repo for each column
+        """
+        self.headers = ['name', 'repo', 'version', 'status'] + columns
+        self.left = []
+        self.codes = Codes()
+        self.cells = []
+        for name, version, cells in packages:
+            self.left.append([name, 'repo', version, 'status'])
+            row = []
+            for cell in cells:
+                if cell not in self.cells:
+                    self.cells.append(cell)
+                row.append(self.cells.index(cell))
+            self.codes.append(row)
+
+
+def setup_module():
+    global _tmpdir
+    _tmpdir = tempfile.mkdtemp()
+
+
+def teardown_module():
+    shutil.rmtree(_tmpdir)
+
+
+def _get_path(name):
+    return os.path.join(_tmpdir, name)
+
+
+def _append_runs(path):
+    history = VersionHistory(path)
+    history.append(VersionsTable([
+        ('foo', '1.0.0', [('1.0.0-0', None, None)]),
+        ('bar', '0.1.0', [('0.1.0-0', '0.1.0-0', None)]),
+    ], ['precise_amd64']), 1000, REPOS)
+    history.append(VersionsTable([
+        ('foo', '1.0.1', [('1.0.1-0', '1.0.0-0', None)]),
+        ('bar', '0.1.0', [('0.1.0-0', '0.1.0-0', None)]),
+    ], ['precise_amd64']), 2000, REPOS)
+    history.append(VersionsTable([
+        ('foo', '1.0.1', [('1.0.1-0', '1.0.0-0', None)]),
+    ], ['precise_amd64']), 3000, REPOS)
+    return history
+
+
+def test_append_and_reload():
+    path = _get_path('append.history')
+    history = _append_runs(path)
+    assert history.runs == [1000, 2000, 3000]
+    assert os.path.exists(path + INDEX_SUFFIX)
+
+    # the same state is loaded from the index and from the log alone
+    for remove_index in [False, True]:
+        if remove_index:
+            os.remove(path + INDEX_SUFFIX)
+        reloaded = VersionHistory(path)
+        assert reloaded.runs == history.runs
+        assert reloaded.repos == REPOS
+        assert reloaded.packages == history.packages
+        assert reloaded._state == history._state
+    # loading never writes the index, appending does
+    assert not os.path.exists(path + INDEX_SUFFIX)
+    reloaded.append(VersionsTable([], ['precise_amd64']), 4000, REPOS)
+    assert os.path.exists(path + INDEX_SUFFIX)
+    assert VersionHistory(path).runs == [1000, 2000, 3000, 4000]
+
+
+def test_unchanged_run():
+    path = _get_path('unchanged.history')
+    history = VersionHistory(path)
+    table = VersionsTable([('foo', '1.0.0', [('1.0.0-0', None, None)])], ['precise_amd64'])
+    assert history.append(table, 1000, REPOS) == 1
+    assert history.append(table, 2000, REPOS) == 0
+    assert len(history.packages['foo']) == 1
+
+
+def test_truncated_record():
+    path = _get_path('truncated.history')
+    _append_runs(path)
+    os.remove(path + INDEX_SUFFIX)
+    size = os.path.getsize(path)
+    # an interrupted run left an incomplete record
+    with open(path, 'ab') as f:
+        f.write('\xff\x00\x00\x00incomplete')
+
+    history = VersionHistory(path)
+    assert history.runs == [1000, 2000, 3000]
+    # loading does not repair the log
+    assert os.path.getsize(path) == size + 14
+
+    history.append(VersionsTable([
+        ('foo', '1.0.2', [('1.0.2-0', '1.0.0-0', None)]),
+    ], ['precise_amd64']), 4000, REPOS)
+    reloaded = VersionHistory(path)
+    assert reloaded.runs == [1000, 2000, 3000, 4000]
+    assert reloaded.get_timeline('foo')[-1] == (4000, 'precise_amd64', ('1.0.2-0', '1.0.0-0', None), REPOS)
+
+
+def test_get_timeline():
+    path = _get_path('timeline.history')
+    history = _append_runs(path)
+    assert history.get_timeline('foo') == [
+        (1000, VERSION_COLUMN, ('1.0.0',), REPOS),
+        (1000, 'precise_amd64', ('1.0.0-0', None, None), REPOS),
+        (2000, VERSION_COLUMN, ('1.0.1',), REPOS),
+        (2000, 'precise_amd64', ('1.0.1-0', '1.0.0-0', None), REPOS),
+    ]
+    assert history.get_timeline('bar') == [
+        (1000, VERSION_COLUMN, ('0.1.0',), REPOS),
+        (1000, 'precise_amd64', ('0.1.0-0', '0.1.0-0', None), REPOS),
+        (3000, None, None, REPOS),
+    ]
+    assert history.get_timeline('baz') == []
+
+
+def test_changed_repos():
+    path = _get_path('repos.history')
+    history = VersionHistory(path)
+    history.append(VersionsTable([
+        ('foo', '1.0.0', [('1.0.0-0', '1.0.0-0', None)]),
+    ], ['precise_amd64']), 1000, REPOS)
+    # the same versions in a different order of the repos
+    repos = ['public', 'building', 'testing']
+    history.append(VersionsTable([
+        ('foo', '1.0.0', [(None, '1.0.0-0', '1.0.0-0')]),
+    ], ['precise_amd64']), 2000, repos)
+
+    history = VersionHistory(path)
+    assert history.get_repos(0) == REPOS
+    assert history.get_repos(1) == repos
+    # each record is labeled with the repos of its own run
+    assert history.get_timeline('foo') == [
+        (1000, VERSION_COLUMN, ('1.0.0',), REPOS),
+        (1000, 'precise_amd64', ('1.0.0-0', '1.0.0-0', None), REPOS),
+        (2000, 'precise_amd64', (None, '1.0.0-0', '1.0.0-0'), repos),
+    ]